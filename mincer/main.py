@@ -93,6 +93,7 @@ def bootstrap():
                                         provider_function_to_call)
             provider_function(**action)
             provider.watch_running_checks()
+        provider.wait_for_uploads()
     except mincer.exceptions.AuthorizationFailure as e:
         LOG.exception(e)
         LOG.error("Connection failed: Authorization failure")
@@ -19,18 +19,58 @@
 import hashlib
 import logging
 import os
+import shutil
 import subprocess
 import tarfile
 import tempfile
+import threading
+
+from concurrent import futures
+
+import mincer.utils.cache
+import mincer.utils.fetch
+import mincer.utils.fingerprint
+from mincer.utils import git_mirror
+from mincer.utils import processes
+from mincer.utils import tree_copy
 
 LOG = logging.getLogger(__name__)
 
+# Number of sources of a dynamic media collected concurrently
+COLLECT_WORKERS = 4
+# Default time limit to collect a source, in seconds
+SOURCE_TIMEOUT = 3600
+# The formats of the generated images
+DYNAMIC_DISK_FORMATS = ('raw', 'qcow2')
+# The parameters used to size the filesystem of a dynamic media, they
+# match the mke2fs defaults
+FS_BLOCK_SIZE = 4096
+INODE_SIZE = 256
+BYTES_PER_INODE = 16384
+JOURNALED_FILESYSTEMS = ('ext3', 'ext4')
+# mkfs refuses to create smaller filesystems
+FILESYSTEM_MIN_SIZE = {'xfs': 300 * 1024 * 1024}
+MB = 1024 * 1024
+# Number of guestfs appliances launched concurrently by generate_medias
+APPLIANCE_WORKERS = 2
+# Number of dynamic medias built with the same guestfs appliance
+DRIVES_PER_APPLIANCE = 8
+
 
 class MediaManagerException(Exception):
 
     """Base class for media manager exceptions."""
 
 
+def _journal_size(fs_size):
+    """Return the size of the journal mke2fs creates for a filesystem."""
+    for limit, journal_size in ((128 * MB, 4 * MB), (1024 * MB, 16 * MB),
+                                (2048 * MB, 32 * MB), (16384 * MB, 64 * MB)):
+        if fs_size < limit:
+            return journal_size
+    return 128 * MB
+
+
 class Media(object):
 
     """Media associated with the application.
@@ -86,7 +126,47 @@ class Media(object):
         * git
             * value: the Git repository URL
             * target: where to store the content
-            * ref: the Git reference to pull. The default is *master*
+            * ref: the Git reference to pull. The default is *HEAD*, the
+              default branch of the repository
+
+      The Git repositories are mirrored in the mincer cache, the next
+      builds only fetch the new commits. The content of the *ref* is
+      exported without the .git directory.
+
+        * local
+            * path: the directory to copy, hidden files included
+            * target: where to store the content
+
+      The files of a local directory are cloned or hardlinked when the
+      filesystem allows it, they must not be modified during the build.
+
+      Each source accepts a *timeout* key, the time limit in seconds to
+      collect it. The default is one hour. The sources are collected
+      concurrently.
+    * disk_format: *raw* (the default) or *qcow2*. The raw image is a sparse
+      file, the qcow2 image only contains the blocks actually written, it
+      is the smallest to upload.
+    * filesystem: the filesystem of the image, the default is *ext2*. The
+      image is sized from the number of inodes and blocks of the data.
+    * cache: reuse the image previously built from the same sources, the
+      default is *true*. The sources are identified by the Git commit
+      behind each *ref*, the text of the scripts and the content of the
+      local directories.
+
+    A dynamic or local media can be converted before its upload with
+    qemu-img:
+
+    * convert_to: the format of the image sent to Glance, e.g. *qcow2*.
+      The zero blocks of a raw image are dropped.
+    * compress: compress the qcow2 image, the default is *false*.
+
+    The converted image is kept next to the original one and reused as
+    long as the original doesn't change. The conversion runs in the upload
+    workers. The checksum and the size of the filter_on policy are the
+    ones of the converted image: the filter doesn't convert the image, a
+    media which was never converted on this machine is uploaded again.
+    For the same reason, a checksum can't be declared for a converted
+    media.
 
     YAML of a bloc media:
 
@@ -112,6 +192,11 @@ class Media(object):
         * disk_format: default is qcow2
         * copy_from: the HTTP URL to the image
         * checksum: the checksum of the image
+        * fetch: download the image on the mincer machine and upload it,
+          instead of letting Glance download it. The default is *false*.
+          The image is fetched with concurrent range requests and kept in
+          the mincer cache, the next runs reuse it while the server
+          reports the same ETag, or while it matches the checksum.
         * filter_on: the policy to use to know if the image already exist on
           the remote location, the key expects a list of parameters. The
           possible parameters are:
@@ -119,6 +204,8 @@ class Media(object):
            * name: just check a media exist with the same name
            * checksum: ensure the remote image checksum match
            * size: just check the size of the image is the same
+           * sources: for a dynamic media, check the remote image was built
+             from the same sources
 
     """
 
@@ -137,17 +224,41 @@ class Media(object):
         self._min_image_size = (1024 * 1024 * 10)
         self.name = name
         self._type = description.get('type')
-        self.checksum = description.get('checksum')
-        self.size = description.get('size', 0)
+        self._checksum = description.get('checksum')
+        self._size = description.get('size')
         self.disk_format = description.get('disk_format', 'raw')
+        # The format of the file on the disk, disk_format is the format
+        # sent to Glance
+        self._source_format = self.disk_format
+        self.convert_to = description.get('convert_to')
+        self.compress = description.get('compress', False)
+        if self.compress and not self.convert_to:
+            self.convert_to = 'qcow2'
+        if self.convert_to:
+            self.disk_format = self.convert_to
         self._local_image = None
-        self.copy_from = description.get('copy_from')
+        self.url = description.get('copy_from')
+        # Download a remote image on the mincer machine instead of Glance
+        self.fetch = bool(self.url) and description.get('fetch', False)
+        self.copy_from = None if self.fetch else self.url
+        self._fetched_image = None
         self.filter_on = description.get('filter_on', 'name')
         self.glance_id = None
 
         if self._type == "dynamic":
             self.basedir = tempfile.mkdtemp()
             self._sources = description['sources']
+            self._use_cache = description.get('cache', True)
+            self._digest = None
+            self._commits = {}
+            # The commands run to collect the sources
+            self._processes = processes.ProcessGroup()
+            self.filesystem = description.get('filesystem', 'ext2')
+            self._generated = False
+            if self._source_format not in DYNAMIC_DISK_FORMATS:
+                raise MediaManagerException(
+                    "%s: a dynamic media can't be generated as '%s'" %
+                    (name, self._source_format))
             self.data_dir = "%s/data" % self.basedir
             self._dynamic_image = "%s/disk.img" % self.basedir
             os.makedirs(self.data_dir)
@@ -157,98 +268,531 @@ class Media(object):
             except KeyError:
                 raise MediaManagerException("Missing key 'path''")
 
-            if not self.checksum and 'checksum' in self.filter_on:
-                self.checksum = hashlib.md5(
-                    open(self._local_image, 'rb').read()).hexdigest()
-            if 'size' in self.filter_on:
-                self.size = os.path.getsize(self._local_image)
+        if self._checksum and self._needs_conversion():
+            raise MediaManagerException(
+                "%s: the checksum of a converted media is unknown before "
+                "its conversion" % name)
 
-    def generate(self):
-        """Publish method to generate an image."""
+    @property
+    def checksum(self):
+        """The MD5 checksum of the image.
+
+        If the checksum is not part of the media description, it is computed
+        from the image file on first access. The checksums of the files are
+        kept in a persistent cache, an unchanged image is not read again.
+        The image isn't converted for that, the checksum of a media whose
+        conversion is not done yet is None.
+        """
+        if self._checksum is None:
+            path = self._ready_path()
+            if path:
+                self._checksum = mincer.utils.fingerprint.checksum(path)
+        return self._checksum
+
+    @checksum.setter
+    def checksum(self, value):
+        self._checksum = value
+
+    @property
+    def size(self):
+        """The size of the image, in bytes.
+
+        If the size is not part of the media description, it is the size of
+        the image file, 0 while the image or its conversion doesn't exist.
+        """
+        if self._size is None:
+            path = self._ready_path()
+            return os.path.getsize(path) if path else 0
+        return self._size
+
+    @size.setter
+    def size(self, value):
+        self._size = value
+
+    @property
+    def digest(self):
+        """The digest of the resolved sources of a dynamic media.
+
+        Two dynamic medias with the same digest produce the same content.
+        """
+        if self._type != "dynamic":
+            return None
+        if self._digest is None:
+            sha = hashlib.sha1()
+            sha.update(('disk_format %s filesystem %s\n' % (
+                self._source_format, self.filesystem)).encode('utf-8'))
+            for source in self._sources:
+                sha.update(self._source_digest(source).encode('utf-8'))
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    def glance_properties(self):
+        """Return the properties to attach to the image in Glance."""
         if self._type == "dynamic":
-            self._collect_data()
-            self._produce_image()
+            return {'mincer_digest': self.digest}
+        return {}
+
+    def generate(self):
+        """Publish method to generate an image.
+
+        A remote media with the fetch key is downloaded in the cache.
+        """
+        if self.fetch:
+            self._fetched_image = mincer.utils.fetch.fetch(self.url,
+                                                           self._checksum)
+            return
+        generate_medias([self])
+
+    def needs_build(self):
+        """Check the image of a dynamic media still has to be generated."""
+        if self._type != "dynamic" or self._generated:
+            return False
+        cached_image = self._cached_image()
+        if cached_image and os.path.exists(cached_image):
+            LOG.info("%s: reusing the image built from the same "
+                     "sources (%s)" % (self.name, self.digest))
+            self._generated = True
+            return False
+        return True
+
+    def _store(self):
+        """Register the generated image, in the build cache if enabled.
+
+        The image is copied next to its final location, then renamed: the
+        other runs never see a partial image in the cache.
+        """
+        self._generated = True
+        self._checksum = None
+        cached_image = self._cached_image()
+        if not cached_image:
+            return
+        fd, tmp_image = tempfile.mkstemp(dir=os.path.dirname(cached_image))
+        os.close(fd)
+        try:
+            shutil.move(self._dynamic_image, tmp_image)
+            os.rename(tmp_image, cached_image)
+        except Exception:
+            if os.path.exists(tmp_image):
+                os.unlink(tmp_image)
+            raise
 
     def getPath(self):
-        """Return the path to the disk image."""
+        """Return the path to the disk image, converted if needed."""
+        path = self._source_path()
+        if path and self._needs_conversion():
+            return self._converted_path(path)
+        return path
+
+    def _ready_path(self):
+        """Return the path to the image if it is ready to upload, or None.
+
+        A converted image is ready if it is more recent than the original.
+        """
+        path = self.getPath()
+        if not path or not os.path.exists(path):
+            return None
+        source = self._source_path()
+        if path != source and os.path.exists(source) and \
+                os.path.getmtime(path) < os.path.getmtime(source):
+            return None
+        return path
+
+    def _source_path(self):
+        """Return the path to the image before its conversion."""
         if self._type == "dynamic":
+            cached_image = self._cached_image()
+            if cached_image and os.path.exists(cached_image):
+                return cached_image
             return self._dynamic_image
         elif self._type == "local":
             return self._local_image
+        return self._fetched_image
+
+    def convert(self):
+        """Convert the image in the convert_to format.
+
+        The converted image is kept next to the original one, or in the
+        mincer cache if this directory is read-only, and reused as long as
+        the original image doesn't change. The image must exist.
+        """
+        if not self._needs_conversion():
+            return
+        source = self._source_path()
+        if not os.path.exists(source) or self._ready_path():
+            return
+        target = self._converted_path(source)
+
+        LOG.info("%s: converting %s to %s" % (self.name, source, target))
+        cmd = ['qemu-img', 'convert', '-f', self._source_format,
+               '-O', self.convert_to]
+        if self.compress:
+            cmd.append('-c')
+        fd, tmp_target = tempfile.mkstemp(dir=os.path.dirname(target))
+        os.close(fd)
+        try:
+            subprocess.check_output(cmd + [source, tmp_target],
+                                    stderr=subprocess.STDOUT)
+            os.rename(tmp_target, target)
+        except (OSError, subprocess.CalledProcessError) as e:
+            os.unlink(tmp_target)
+            raise MediaManagerException("%s: conversion failed: %s" %
+                                        (self.name,
+                                         getattr(e, 'output', None) or e))
+        self._checksum = None
+
+    def _quick_key(self):
+        """Return a cheap identifier of the content of the media, or None.
+
+        Two local images with the same size may still be different.
+        """
+        if self._type == "dynamic":
+            return ('dynamic', self.disk_format, self.compress, self.digest)
+        elif self._type == "local":
+            if not os.path.exists(self._source_path()):
+                return None
+            return ('local', self.disk_format, self.compress,
+                    os.path.getsize(self._source_path()))
+        elif self.url:
+            return ('remote', self.disk_format, self.url)
+
+    def _content_key(self):
+        """Return the identifier of the content of the media, or None."""
+        if self._type == "local":
+            return ('local', self.disk_format, self.compress,
+                    mincer.utils.fingerprint.checksum(self._source_path()))
+        return self._quick_key()
+
+    def _needs_conversion(self):
+        """Check the image has to be converted before the upload."""
+        if not self.convert_to or self._type not in ("dynamic", "local"):
+            return False
+        return self.compress or self.convert_to != self._source_format
+
+    def _converted_path(self, source):
+        """Return the location of the converted image."""
+        suffix = '.compressed' if self.compress else ''
+        name = "%s%s.%s" % (os.path.basename(source), suffix,
+                            self.convert_to)
+        directory = os.path.dirname(os.path.abspath(source))
+        if not os.access(directory, os.W_OK):
+            directory = mincer.utils.cache.cache_dir(
+                'converted', hashlib.sha1(os.path.realpath(
+                    source).encode('utf-8')).hexdigest())
+        return os.path.join(directory, name)
+
+    def _cached_image(self):
+        """Return the location of the image in the build cache, or None."""
+        if not self._use_cache:
+            return None
+        return os.path.join(
+            mincer.utils.cache.cache_dir('medias', self.digest), 'disk.img')
+
+    def _source_digest(self, source):
+        """Return a string which identifies the content of a source."""
+        if source['driver'] == 'git':
+            content = self._resolve_git(source)
+        elif source['driver'] == 'local':
+            content = mincer.utils.fingerprint.tree_digest(source['path'])
+        elif source['driver'] == 'script':
+            content = hashlib.sha1(source['value'].encode(
+                'utf-8')).hexdigest()
+        else:
+            raise MediaManagerException("Unknown source type '%s'" %
+                                        source['driver'])
+        return "%s %s %s\n" % (source['driver'], source['target'], content)
 
     def _collect_data(self):
         """Process the different sources
 
         Retrieve the ressources from different localisation and
-        store them in a work directory
+        store them in a work directory. The sources write in distinct
+        target directories, they are collected concurrently by a pool of
+        COLLECT_WORKERS workers. The first failure stops the collection.
         """
         for source in self._sources:
-
-            target_dir = "%s/%s" % (self.data_dir, source['target'])
-            os.makedirs(target_dir)
-            LOG.debug("target_dir: '%s'" % target_dir)
-
-            if source['driver'] == 'git':
-                subprocess.call(["git", "clone", "--depth", "1",
-                                 source['value'], target_dir],
-                                cwd=self.data_dir)
-            elif source['driver'] == 'local':
-                subprocess.call("cp -r %s/* %s" % (source['path'], target_dir),
-                                shell=True)
-            elif source['driver'] == 'script':
-                os.environ['BASE_DIR'] = os.getcwd()
-                f = tempfile.NamedTemporaryFile(delete=False)
+            if source['driver'] not in ('git', 'local', 'script'):
+                raise MediaManagerException("Unknown source type '%s'" %
+                                            source['driver'])
+
+        # The scripts find the samples of the marmite from there
+        env = dict(os.environ, BASE_DIR=os.getcwd())
+        with futures.ThreadPoolExecutor(
+                max_workers=COLLECT_WORKERS) as executor:
+            jobs = [executor.submit(self._collect_source, source, env)
+                    for source in self._sources]
+            done, not_done = futures.wait(
+                jobs, return_when=futures.FIRST_EXCEPTION)
+            failures = [job for job in done if job.exception()]
+            if failures:
+                for job in not_done:
+                    job.cancel()
+                self._processes.kill()
+                raise failures[0].exception()
+
+    def _collect_source(self, source, env):
+        """Retrieve the content of a source in its target directory."""
+        target_dir = "%s/%s" % (self.data_dir, source['target'])
+        os.makedirs(target_dir)
+        LOG.debug("target_dir: '%s'" % target_dir)
+        timeout = source.get('timeout', SOURCE_TIMEOUT)
+
+        if source['driver'] == 'git':
+            commit = self._resolve_git(source)
+            try:
+                git_mirror.GitMirror(source['value']).export(
+                    commit, target_dir, timeout, self._processes)
+            except git_mirror.GitMirrorError as e:
+                raise MediaManagerException("%s: %s" % (self.name, e))
+        elif source['driver'] == 'local':
+            try:
+                tree_copy.copy_tree(source['path'], target_dir)
+            except (IOError, OSError) as e:
+                raise MediaManagerException("%s: failed to copy '%s': %s" %
+                                            (self.name, source['path'], e))
+        elif source['driver'] == 'script':
+            f = tempfile.NamedTemporaryFile(mode='w', delete=False)
+            try:
                 f.write(source['value'])
                 f.close()
-                subprocess.call(["chmod", "+x", f.name])
-                subprocess.call([f.name], cwd=target_dir)
+                os.chmod(f.name, 0o700)
+                self._call([f.name], timeout, cwd=target_dir, env=env)
+            finally:
                 os.unlink(f.name)
-            else:
-                raise MediaManagerException("Unknown source type '%s'" %
-                                            source['type'])
 
-    def _size_to_allocate(self, tarfile_path):
-        """Return the size to allocate for the image."""
-        # The final size consists of the size of the tar file and
-        # the size of the metadatas of the FS which is majored to 15 percent.
-        # For the same reason, we ensure size is greater than
-        # self._min_image_size.
-        disk_image_size = os.path.getsize(tarfile_path) * 1.15
-        if disk_image_size < self._min_image_size:
-            disk_image_size = self._min_image_size
+    def _resolve_git(self, source):
+        """Return the commit to use for a Git source.
 
-        return disk_image_size
+        The reference is resolved once, the content of the media is then
+        consistent with its digest even if the remote branch moves.
+        """
+        key = (source['value'], source.get('ref', 'HEAD'))
+        if key not in self._commits:
+            mirror = git_mirror.GitMirror(source['value'])
+            try:
+                self._commits[key] = mirror.resolve(
+                    key[1], source.get('timeout', SOURCE_TIMEOUT),
+                    self._processes)
+            except git_mirror.GitMirrorError as e:
+                raise MediaManagerException("%s: %s" % (self.name, e))
+        return self._commits[key]
+
+    def _call(self, cmd, timeout, **kwargs):
+        """Run a command, raise MediaManagerException if it fails.
+
+        :param cmd: the command to run
+        :type cmd: list
+        :param timeout: the time limit of the command in seconds, or None
+        :type timeout: float
+        :returns: None
+        :rtype: None
 
-    def _produce_image(self):
-        """Push the collected data in an image."""
+        """
         try:
-            import guestfs
-        except ImportError:
-            LOG.error("python-guestfs package is required to "
-                      "produce 'dynamic' image")
-            guestfs = None
-
-        tarfile_path = "%s/final.tar" % self.basedir
-        with tarfile.open(tarfile_path, "w") as tar:
-            tar.add(self.data_dir, arcname=os.path.basename(self.data_dir))
-
-        disk_image_size = self._size_to_allocate(tarfile_path)
-        g = None
+            returncode, output, _ = processes.run(
+                cmd, timeout, self._processes, stderr=subprocess.STDOUT,
+                **kwargs)
+        except processes.ProcessTimeout as e:
+            raise MediaManagerException("%s: %s" % (self.name, e))
+        if returncode != 0:
+            raise MediaManagerException(
+                "%s: '%s' failed with code %d: %s" %
+                (self.name, ' '.join(cmd), returncode,
+                 output.decode('utf-8', 'replace')))
+        LOG.debug(output.decode('utf-8', 'replace'))
+
+    def _size_to_allocate(self, data_dir):
+        """Return the size to allocate for the image."""
+        # The data needs one inode per entry and the blocks of the files
+        # and directories. The filesystem needs enough space to get one
+        # inode per BYTES_PER_INODE with the default mkfs options. The
+        # other metadatas and the reserved blocks are majored to 15
+        # percent, plus the journal if any. For the same reason, we ensure
+        # size is greater than self._min_image_size.
+        inodes = 1
+        blocks = 1
+        for root, dirs, files in os.walk(data_dir):
+            for name in dirs + files:
+                inodes += 1
+                stat = os.lstat(os.path.join(root, name))
+                blocks += -(-stat.st_size // FS_BLOCK_SIZE)
+
+        data_size = blocks * FS_BLOCK_SIZE + inodes * INODE_SIZE
+        disk_image_size = max(data_size, inodes * BYTES_PER_INODE) * 1.15
+        if self.filesystem in JOURNALED_FILESYSTEMS:
+            disk_image_size += _journal_size(disk_image_size)
+        disk_image_size = max(disk_image_size, self._min_image_size,
+                              FILESYSTEM_MIN_SIZE.get(self.filesystem, 0))
+
+        # disk_create expects a multiple of the sector size
+        return int(-(-disk_image_size // MB) * MB)
+
+    def _tar_in(self, g, directory):
+        """Stream the collected data in a directory of the appliance.
+
+        The tar stream is written in a pipe by a thread while guestfs
+        reads it, nothing is stored on the local disk.
+        """
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def write_tar():
+            try:
+                with os.fdopen(write_fd, 'wb') as stream:
+                    with tarfile.open(fileobj=stream, mode='w|') as tar:
+                        tar.add(self.data_dir,
+                                arcname=os.path.basename(self.data_dir))
+            except (IOError, OSError, tarfile.TarError) as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=write_tar)
+        writer.start()
         try:
+            g.tar_in('/dev/fd/%d' % read_fd, directory)
+        finally:
+            # Unblock the writer if guestfs stopped reading
+            os.close(read_fd)
+            writer.join()
+        if errors:
+            raise MediaManagerException("%s: failed to stream the data: %s"
+                                        % (self.name, errors[0]))
+
+    def _add_drive(self, g):
+        """Create the disk image and attach it to a guestfs appliance."""
+        disk_image_size = self._size_to_allocate(self.data_dir)
+        if self._source_format == 'qcow2':
+            # Only the clusters written by mkfs and tar_in are allocated
+            g.disk_create(self._dynamic_image, 'qcow2', disk_image_size)
+        else:
+            # A sparse file, the blocks are allocated as they are written
             with open(self._dynamic_image, "w") as f:
                 f.truncate(disk_image_size)
 
-            g = guestfs.GuestFS()
-            g.add_drive_opts(self._dynamic_image, format="raw", readonly=0)
-            g.launch()
-            devices = g.list_devices()
-            assert len(devices) == 1
-            g.part_disk(devices[0], "mbr")
-            partitions = g.list_partitions()
-            g.mkfs("ext2", partitions[0])
-            g.mount(partitions[0], "/")
-            g.tar_in(tarfile_path, '/')
-            os.unlink(tarfile_path)
-        finally:
-            if g:
-                g.close()
+        g.add_drive_opts(self._dynamic_image, format=self._source_format,
+                         readonly=0)
+
+    def _fill_drive(self, g, device):
+        """Create the filesystem of a drive and push the collected data."""
+        LOG.debug("%s: filling %s" % (self.name, device))
+        g.part_disk(device, "mbr")
+        partitions = [partition for partition in g.list_partitions()
+                      if g.part_to_dev(partition) == device]
+        g.mkfs(self.filesystem, partitions[0])
+        g.mount(partitions[0], "/")
+        self._tar_in(g, '/')
+        g.umount_all()
+
+    def _produce_image(self):
+        """Push the collected data in an image."""
+        _produce_images([self])
+
+
+def _produce_images(medias):
+    """Push the collected data of several medias with one appliance.
+
+    The drives have to be attached before the launch of the appliance,
+    they are then filled one after the other.
+    """
+    try:
+        import guestfs
+    except ImportError:
+        LOG.error("python-guestfs package is required to "
+                  "produce 'dynamic' image")
+        guestfs = None
+
+    g = None
+    try:
+        g = guestfs.GuestFS()
+        for media in medias:
+            media._add_drive(g)
+        g.launch()
+        devices = g.list_devices()
+        assert len(devices) == len(medias)
+        for media, device in zip(medias, devices):
+            media._fill_drive(g, device)
+    finally:
+        if g:
+            g.close()
+
+
+def deduplicate(medias):
+    """Group the medias which produce the same image.
+
+    The medias of a group have the same disk_format and the same source:
+    the same copy_from URL, the same local image content or the same
+    dynamic media digest. The checksum of a local image is only computed
+    if another local image has the same size.
+
+    :param medias: the medias
+    :type medias: list
+    :returns: the groups of medias, sorted by name
+    :rtype: list of lists
+
+    """
+    groups = []
+    buckets = {}
+    for media in sorted(medias, key=lambda media: media.name):
+        key = media._quick_key()
+        if key is None:
+            groups.append([media])
+        elif key in buckets:
+            buckets[key].append(media)
+        else:
+            buckets[key] = [media]
+            groups.append(buckets[key])
+
+    result = []
+    for group in groups:
+        if len(group) == 1:
+            result.append(group)
+            continue
+        by_content = {}
+        for media in group:
+            key = media._content_key()
+            if key not in by_content:
+                by_content[key] = []
+                result.append(by_content[key])
+            by_content[key].append(media)
+    return result
+
+
+def generate_medias(medias, appliance_workers=APPLIANCE_WORKERS,
+                    drives_per_appliance=DRIVES_PER_APPLIANCE):
+    """Generate the images of several dynamic medias.
+
+    Launching a guestfs appliance boots a small VM, this is often longer
+    than building a small image. The medias are built by batches of
+    drives_per_appliance drives sharing the same appliance, and
+    appliance_workers appliances run concurrently. The medias which don't
+    need a build are ignored.
+
+    :param medias: the medias
+    :type medias: list
+    :param appliance_workers: the number of concurrent appliances
+    :type appliance_workers: int
+    :param drives_per_appliance: the number of medias per appliance
+    :type drives_per_appliance: int
+    :returns: None
+    :rtype: None
+
+    """
+    to_build = [media for media in medias if media.needs_build()]
+    if not to_build:
+        return
+
+    with futures.ThreadPoolExecutor(max_workers=COLLECT_WORKERS) as executor:
+        for job in [executor.submit(media._collect_data)
+                    for media in to_build]:
+            job.result()
+
+    batches = [to_build[i:i + drives_per_appliance]
+               for i in range(0, len(to_build), drives_per_appliance)]
+    LOG.info("Generating %d media(s) with %d appliance(s)" % (
+        len(to_build), len(batches)))
+    with futures.ThreadPoolExecutor(
+            max_workers=appliance_workers) as executor:
+        for job in [executor.submit(_produce_images, batch)
+                    for batch in batches]:
+            job.result()
+
+    for media in to_build:
+        media._store()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Index the Glance images to resolve the medias."""
+
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# The image attributes we can look up in constant time
+INDEXED_KEYS = ('name', 'checksum', 'size', 'sources')
+# The keys stored as image properties, and the matching media attribute
+PROPERTY_KEYS = {'sources': ('mincer_digest', 'digest')}
+
+
+def _image_value(image, key):
+    """Return the value of an indexed key for a Glance image."""
+    if key in PROPERTY_KEYS:
+        properties = getattr(image, 'properties', None) or {}
+        return properties.get(PROPERTY_KEYS[key][0])
+    return getattr(image, key, None)
+
+
+def _media_value(local_media, key):
+    """Return the value of an indexed key for a media."""
+    if key in PROPERTY_KEYS:
+        return getattr(local_media, PROPERTY_KEYS[key][1])
+    return getattr(local_media, key)
+
+
+class ImageCatalog(object):
+
+    """A snapshot of the Glance images, indexed by their attributes.
+
+    The images are listed once and indexed by disk_format and by each of
+    the INDEXED_KEYS. Only the active images are indexed, the others can't
+    be used by a stack anyway.
+    """
+
+    def __init__(self, images=()):
+        """ImageCatalog constructor
+
+        :param images: the images as returned by glanceclient
+        :type images: iterable
+        :returns: None
+        :rtype: None
+
+        """
+        self._by_id = {}
+        self._by_format = {}
+        self._indexes = dict((key, {}) for key in INDEXED_KEYS)
+        for image in images:
+            self.add(image)
+
+    @classmethod
+    def from_glance(cls, glance):
+        """Build a catalog from a single listing of the Glance images.
+
+        :param glance: the Glance client
+        :type glance: glanceclient.Client
+        :returns: the catalog
+        :rtype: ImageCatalog
+
+        """
+        catalog = cls(glance.images.list())
+        LOG.debug("%d active image(s) in Glance" % len(catalog))
+        return catalog
+
+    def __len__(self):
+        """Return the number of active images in the catalog."""
+        return len(self._by_id)
+
+    def add(self, image):
+        """Register an image in the catalog.
+
+        :param image: a Glance image
+        :type image: glanceclient.v1.images.Image
+        :returns: None
+        :rtype: None
+
+        """
+        if image.status != 'active':
+            return
+        self._by_id[image.id] = image
+        self._by_format.setdefault(image.disk_format, []).append(image)
+        for key in INDEXED_KEYS:
+            value = _image_value(image, key)
+            if value is None:
+                continue
+            self._indexes[key].setdefault(
+                (image.disk_format, value), []).append(image)
+
+    def find(self, disk_format, **criteria):
+        """Return the active images matching the criteria.
+
+        The images keep the order of the Glance listing.
+
+        :param disk_format: the expected disk_format
+        :type disk_format: str
+        :param criteria: the expected values of the INDEXED_KEYS
+        :type criteria: dict
+        :returns: the matching images
+        :rtype: list
+
+        """
+        candidates = self._by_format.get(disk_format, [])
+        for key, value in criteria.items():
+            indexed = self._indexes[key].get((disk_format, value), [])
+            if len(indexed) < len(candidates):
+                candidates = indexed
+        return [image for image in candidates
+                if all(_image_value(image, key) == value
+                       for key, value in criteria.items())]
+
+    def find_media(self, local_media):
+        """Return the active image matching a media, or None.
+
+        The media filter_on policy defines the criteria to use. If several
+        images match, the last one of the listing is returned.
+
+        :param local_media: the media
+        :type local_media: mincer.media.Media
+        :returns: the image
+        :rtype: glanceclient.v1.images.Image
+
+        """
+        criteria = dict((key, _media_value(local_media, key))
+                        for key in INDEXED_KEYS
+                        if key in local_media.filter_on)
+        images = self.find(local_media.disk_format, **criteria)
+        if images:
+            return images[-1]
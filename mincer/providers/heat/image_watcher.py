@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Follow the status of the images being uploaded in Glance."""
+
+import logging
+import time
+
+import glanceclient.exc
+
+LOG = logging.getLogger(__name__)
+
+# Bounds of the polling interval, in seconds
+POLL_INTERVAL_MIN = 1
+POLL_INTERVAL_MAX = 15
+# Growth of the polling interval when nothing happens
+POLL_BACKOFF = 1.5
+# Default time after which an image which keeps the same status is
+# considered stuck, in seconds. A queued image should start to be saved
+# quickly, the time to save an image depends on its size and the network.
+STUCK_TIMEOUTS = {'queued': 300}
+# The statuses an image can't leave
+FAILED_STATUSES = ('killed', 'deleted', 'pending_delete')
+
+
+class ImageWatcher(object):
+
+    """Keep track of the status of a set of images.
+
+    The images are fetched with one listing per update, the active ones
+    are dropped from the watch set.
+    """
+
+    def __init__(self, glance, image_ids, stuck_timeouts=None):
+        """ImageWatcher constructor
+
+        :param glance: the Glance client
+        :type glance: glanceclient.Client
+        :param image_ids: the IDs of the images to watch
+        :type image_ids: iterable
+        :param stuck_timeouts: the time limit of each status in seconds,
+         STUCK_TIMEOUTS by default
+        :type stuck_timeouts: dict
+        :returns: None
+        :rtype: None
+
+        """
+        self._glance = glance
+        now = time.time()
+        self.pending = set(image_ids)
+        self.failed = {}
+        self.interval = POLL_INTERVAL_MIN
+        self._stuck_timeouts = stuck_timeouts
+        if stuck_timeouts is None:
+            self._stuck_timeouts = STUCK_TIMEOUTS
+        self._status = dict((image_id, (None, now))
+                            for image_id in self.pending)
+
+    def watch(self, image_id):
+        """Add an image to the watch set.
+
+        The polling interval is reset, the new image may already be active.
+
+        :param image_id: the ID of the image
+        :type image_id: str
+        :returns: None
+        :rtype: None
+
+        """
+        if image_id not in self.pending:
+            self.pending.add(image_id)
+            self._status[image_id] = (None, time.time())
+        self.interval = POLL_INTERVAL_MIN
+
+    def update(self):
+        """Fetch the status of the pending images.
+
+        The polling interval is reset when a status changed and grows
+        otherwise.
+
+        :returns: the images which are now active, indexed by ID
+        :rtype: dict
+
+        """
+        images = dict((image.id, image) for image in self._glance.images.list()
+                      if image.id in self.pending)
+        for image_id in self.pending - set(images):
+            # Not part of the listing, probably not visible anymore
+            try:
+                images[image_id] = self._glance.images.get(image_id)
+            except glanceclient.exc.HTTPNotFound:
+                self.failed[image_id] = 'deleted'
+
+        now = time.time()
+        changed = False
+        active = {}
+        for image_id, image in images.items():
+            if image.status != self._status[image_id][0]:
+                changed = True
+                self._status[image_id] = (image.status, now)
+            if image.status == 'active':
+                active[image_id] = image
+            elif image.status in FAILED_STATUSES:
+                self.failed[image_id] = image.status
+        self.pending -= set(active)
+        self.pending -= set(self.failed)
+
+        if changed:
+            self.interval = POLL_INTERVAL_MIN
+        else:
+            self.interval = min(self.interval * POLL_BACKOFF,
+                                POLL_INTERVAL_MAX)
+        return active
+
+    def stuck(self):
+        """Return the images which kept the same status for too long.
+
+        :returns: the IDs and the status of the images
+        :rtype: dict
+
+        """
+        now = time.time()
+        stuck = {}
+        for image_id in self.pending:
+            status, since = self._status[image_id]
+            timeout = self._stuck_timeouts.get(status)
+            if timeout is not None and now - since > timeout:
+                stuck[image_id] = status
+        return stuck
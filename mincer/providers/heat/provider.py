@@ -14,15 +14,21 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import codecs
+import json
 import logging
+import os
+import select
 import string
 import tempfile
+import threading
 import time
 import uuid
 
 from concurrent import futures
 from Crypto.PublicKey import RSA
 import glanceclient
+import glanceclient.exc
 import heatclient.client as heatclient
 from heatclient.common import template_utils
 import heatclient.exc as heatclientexc
@@ -36,12 +42,31 @@ import swiftclient
 
 import mincer.exceptions
 from mincer import media
+from mincer.providers.heat import image_catalog
+from mincer.providers.heat import image_watcher
+from mincer.providers.heat import stack_watcher
+import mincer.utils.progress
+import mincer.utils.retry
 import mincer.utils.ssh
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
-RETRY_MAX = 1000
+# Default time limit of a stack creation or update, in seconds
+STACK_TIMEOUT = 2000
+# Default number of medias to generate and upload at the same time
+UPLOAD_WORKERS = 4
+# How to retry an upload, see mincer.utils.retry.RetryPolicy
+UPLOAD_RETRY = {'initial_delay': 5, 'max_delay': 60, 'max_attempts': 3}
+# The errors after which an upload is worth retrying
+RETRYABLE_UPLOAD_ERRORS = (glanceclient.exc.CommunicationError,
+                           glanceclient.exc.HTTPBadGateway,
+                           glanceclient.exc.HTTPInternalServerError,
+                           glanceclient.exc.HTTPServiceUnavailable)
+# Size of the reads on the SSH channels
+RECV_BUFFER_SIZE = 32768
+# Maximum time to block on a SSH channel, in seconds
+SELECT_TIMEOUT = 1
 
 
 class Heat(object):
@@ -68,8 +93,18 @@ class Heat(object):
         self.floating_ips = {}
         self._application_stack = None
         self._tester_stack = None
+        self._stack_watchers = {}
+        self._machines = None
+        self._machines_stack_id = None
         self._check_sessions = []
         self._ssh_client = None
+        self.upload_stats = {}
+        # The futures of the images, indexed by stack parameter
+        self._images = {}
+        # The uploads running in the background
+        self._uploads = []
+        # Set to stop the uploads, see cleanup()
+        self._uploads_cancelled = threading.Event()
         self._pub_key = None
         self._priv_key = None
 
@@ -128,9 +163,18 @@ resources:
 """
 
     def ssh_client(self):
-        """Return the SSH client instance."""
+        """Return the SSH client instance.
+
+        The optional `ssh_retry` provider parameter overrides the retry
+        policy of the SSH connections, see mincer.utils.retry.RetryPolicy.
+        """
         if not self._ssh_client:
-            self._ssh_client = mincer.utils.ssh.SSH(self.priv_key())
+            retry_policy = None
+            if 'ssh_retry' in self.params:
+                retry_policy = mincer.utils.retry.RetryPolicy(
+                    **self.params['ssh_retry'])
+            self._ssh_client = mincer.utils.ssh.SSH(
+                self.priv_key(), retry_policy=retry_policy)
         return self._ssh_client
 
     def pub_key(self):
@@ -212,112 +256,343 @@ resources:
         )
 
     def _filter_medias(self, medias, refresh_medias):
-        """Return a tuple of two dicts.
+        """Resolve the medias against the images already in Glance.
 
-        The first dict corresponds to the medias which need to be uploaded
-        and the second corresponds to the medias which does not.
+        Glance is listed only once, the medias are then resolved against
+        the resulting image catalog. The glance_id of a media is set if an
+        image matches its filter_on policy, unless it has to be refreshed.
 
-        :param medias: list of Media objects
-        :type medias: list
+        :param medias: the medias indexed by name
+        :type medias: dict
         :param refresh_medias: list of medias names to refresh
         :type refresh_medias: list
+        :returns: a copy of the medias dict
+        :rtype: dict
         """
+        catalog = image_catalog.ImageCatalog.from_glance(self._glance)
         medias_to_upload = medias.copy()
         for media_to_upload in medias_to_upload.values():
-            for media_in_glance in self._glance.images.list():
-                if media_in_glance.disk_format != media_to_upload.disk_format:
-                    continue
-                if media_in_glance.status != 'active':
-                    continue
-                if media_to_upload.name in refresh_medias:
-                    continue
-                if 'name' in media_to_upload.filter_on:
-                    if media_to_upload.name != media_in_glance.name:
-                        continue
-                if 'size' in media_to_upload.filter_on:
-                    if media_to_upload.size != media_in_glance.size:
-                        continue
-                if 'checksum' in media_to_upload.filter_on:
-                    if media_to_upload.checksum != media_in_glance.checksum:
-                        continue
-                LOG.info("An image '%s' already exist in Glance (%s) "
-                         "and match the criteria (%s)." % (
-                             media_to_upload.name,
-                             media_in_glance.id,
-                             ", ".join(media_to_upload.filter_on)))
-                media_to_upload.glance_id = media_in_glance.id
+            if media_to_upload.name in refresh_medias:
+                continue
+            media_in_glance = catalog.find_media(media_to_upload)
+            if media_in_glance is None:
+                continue
+            LOG.info("An image '%s' already exist in Glance (%s) "
+                     "and match the criteria (%s)." % (
+                         media_to_upload.name,
+                         media_in_glance.id,
+                         ", ".join(media_to_upload.filter_on)))
+            media_to_upload.glance_id = media_in_glance.id
 
         return medias_to_upload
 
-    def upload(self, medias, refresh_medias):
+    def upload(self, medias, refresh_medias, wait=True):
         """Upload medias in Glance.
 
+        Each media gets the future of its volume_id_<name> stack parameter,
+        resolved when its image is active. With wait=False, the uploads
+        continue in the background and a stack only waits for the images
+        its template references, see _wait_for_images.
+
         :param medias: list of Media objects
         :type medias: list
         :param refresh_medias: list of medias names to refresh
         :type refresh_medias: list
+        :param wait: wait until all the images are active
+        :type wait: bool
+        """
+        for name in medias:
+            self._images['volume_id_%s' % name] = futures.Future()
+        if wait:
+            self._upload_and_wait(medias, refresh_medias)
+            return
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        self._uploads.append(executor.submit(self._upload_and_wait,
+                                             medias, refresh_medias))
+        executor.shutdown(wait=False)
+
+    def _upload_and_wait(self, medias, refresh_medias):
+        """Upload the medias and wait for their images to be active.
+
+        If it fails, the futures of the images still pending get the
+        exception.
         """
-        medias_to_upload = self._filter_medias(medias, refresh_medias)
-        self._upload_medias(medias_to_upload)
-        self._wait_for_medias_in_glance(medias_to_upload)
-
-    def _show_media_upload_status(self, name, fd, size):
-        time.sleep(5)
         try:
-            LOG.info("%s: %5dM /%5dM" % (
-                name,
-                fd.tell() / 1024 / 1024,
-                size / 1024 / 1024))
+            medias_to_upload = self._filter_medias(medias, refresh_medias)
+            # Only the medias without an image in Glance are compared
+            groups = media.deduplicate(
+                [local_media for local_media in medias_to_upload.values()
+                 if not local_media.glance_id])
+            self._upload_medias(
+                self._skip_duplicates(medias_to_upload, groups), groups)
         except Exception as e:
-            LOG.exception(e)
-            pass
+            for name in medias:
+                image = self._images['volume_id_%s' % name]
+                if not image.done():
+                    image.set_exception(e)
+            raise
 
-    def _upload_medias(self, medias_to_upload):
-        for local_media in medias_to_upload.values():
-            if local_media.glance_id:
-                LOG.info("%s already in Glance (%s)" % (
-                    local_media.name, local_media.glance_id))
-                continue
+    def _wait_for_images(self, template):
+        """Wait for the images referenced by a stack template.
 
-            local_media.generate()
-            image = self._glance.images.create(name=local_media.name)
-            local_media.glance_id = image.id
-            # TODO(Gonéri) clean the image in case of failure
-            if local_media.copy_from:
-                LOG.info("Downloading '%s' from %s" % (local_media.name,
-                                                      local_media.copy_from))
-                image.update(container_format='bare',
-                             disk_format=local_media.disk_format,
-                             copy_from=local_media.copy_from)
-            else:
-                with open(local_media.getPath(), "rb") as media_fd:
-                    LOG.info("Uploading %s to %s" % (local_media.getPath(),
-                                                     local_media.name))
-                    with futures.ThreadPoolExecutor(max_workers=1) as executor:
-                        upload = executor.submit(
-                            image.update, container_format='bare',
-                            disk_format=local_media.disk_format,
-                            data=media_fd)
-                        while upload.running():
-                            self._show_media_upload_status(
-                                local_media.name,
-                                media_fd,
-                                local_media.size)
-
-    def _wait_for_medias_in_glance(self, medias_to_upload):
-        LOG.info("Checking the image(s) status")
-        while len(self.medias) != len(medias_to_upload):
+        The images are the parameters of the template named after a media,
+        volume_id_<name>. A template which isn't parsed as a dict waits for
+        all the images. The failure of an upload is raised here.
+
+        :param template: the template as returned by
+         template_utils.get_template_contents
+        :type template: dict
+        """
+        if isinstance(template, dict):
+            names = [name for name in template.get('parameters') or {}
+                     if name in self._images]
+        else:
+            names = list(self._images)
+        for name in sorted(names):
+            if not self._images[name].done():
+                LOG.info("Waiting for the image of %s" %
+                         name[len('volume_id_'):])
+            self._images[name].result()
+
+    def _check_uploads(self):
+        """Raise the error of a failed background upload."""
+        for upload in self._uploads:
+            if upload.done():
+                upload.result()
+
+    def _check_cancelled(self, name):
+        """Stop an upload if the uploads were cancelled."""
+        if self._uploads_cancelled.is_set():
+            raise UploadError("%s: upload cancelled" % name)
+
+    def wait_for_uploads(self):
+        """Wait for the end of the background uploads.
+
+        The error of a failed upload is raised, even if no stack uses its
+        image.
+        """
+        futures.wait(self._uploads)
+        for upload in self._uploads:
+            upload.result()
+
+    def _skip_duplicates(self, medias_to_upload, groups):
+        """Keep only the first media of each group of duplicates.
+
+        :param medias_to_upload: the medias indexed by name
+        :type medias_to_upload: dict
+        :param groups: the medias which produce the same image, see
+         mincer.media.deduplicate
+        :type groups: list of lists
+        :returns: the medias to upload, indexed by name
+        :rtype: dict
+        """
+        duplicates = set()
+        for group in groups:
+            if len(group) > 1:
+                LOG.info("%s will share the image of %s" % (
+                    ", ".join(m.name for m in group[1:]), group[0].name))
+                duplicates.update(m.name for m in group[1:])
+        return dict((name, local_media)
+                    for name, local_media in medias_to_upload.items()
+                    if name not in duplicates)
+
+    def _upload_medias(self, medias_to_upload, groups=()):
+        """Upload the medias concurrently and wait for their images.
+
+        The dynamic medias are generated together, so they share the
+        guestfs appliances, while the other medias are uploaded. Each
+        dynamic media is uploaded as soon as the build is over. The number
+        of workers comes from the `upload_workers` provider parameter.
+
+        The status of an image is followed as soon as its upload is over,
+        while the other uploads go on, see _update_images_status. The
+        medias already in Glance are followed from the start.
+
+        The statistics of the uploads are kept in upload_stats and logged
+        as JSON at the end.
+
+        :param medias_to_upload: the medias indexed by name
+        :type medias_to_upload: dict
+        :param groups: the medias which produce the same image, see
+         mincer.media.deduplicate. The first media of a group gives its
+         image to the others.
+        :type groups: list of lists
+        """
+        workers = self.params.get('upload_workers', UPLOAD_WORKERS)
+        self.upload_stats = {}
+        duplicates = dict((group[0].name, group[1:]) for group in groups)
+        watcher = image_watcher.ImageWatcher(
+            self._glance, [], self.params.get('image_stuck_timeouts'))
+        medias_by_id = {}
+
+        def watch(local_media):
+            for other_media in [local_media] + duplicates.get(
+                    local_media.name, []):
+                other_media.glance_id = local_media.glance_id
+                medias_by_id.setdefault(local_media.glance_id, []).append(
+                    other_media)
+            watcher.watch(local_media.glance_id)
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            # The running uploads and the media they upload, None for the
+            # build of the dynamic medias
+            uploads = {}
+            to_build = []
             for local_media in medias_to_upload.values():
-                image = self._glance.images.get(local_media.glance_id)
-                if image.status == 'active':
-                    LOG.info("Image %s is ready" % image.name)
-                    local_media_id = local_media.glance_id
-                    self.medias['volume_id_%s' % image.name] = local_media_id
-                elif image.status == 'killed':
-                    raise ImageException("Error while waiting for image")
+                if local_media.glance_id:
+                    LOG.info("%s already in Glance (%s)" % (
+                        local_media.name, local_media.glance_id))
+                    watch(local_media)
+                elif local_media.needs_build():
+                    to_build.append(local_media)
                 else:
-                    LOG.info("waiting for %s", local_media.name)
-                    time.sleep(5)
+                    uploads[executor.submit(
+                        self._upload_media, local_media)] = local_media
+            if to_build:
+                uploads[executor.submit(
+                    media.generate_medias, to_build)] = None
+
+            names = ", ".join(sorted(medias_to_upload))
+            next_poll = time.time()
+            try:
+                while uploads:
+                    self._check_cancelled(names)
+                    timeout = None
+                    if watcher.pending:
+                        if time.time() >= next_poll:
+                            self._update_images_status(watcher,
+                                                       medias_by_id)
+                            next_poll = time.time() + watcher.interval
+                        timeout = max(0, next_poll - time.time())
+                    # Wake up on each completion, or to poll Glance
+                    done, _ = futures.wait(
+                        list(uploads), timeout=timeout,
+                        return_when=futures.FIRST_COMPLETED)
+                    for upload in done:
+                        local_media = uploads.pop(upload)
+                        upload.result()
+                        if local_media is None:
+                            for built_media in to_build:
+                                uploads[executor.submit(
+                                    self._upload_media,
+                                    built_media)] = built_media
+                        else:
+                            # The image is often active once uploaded
+                            watch(local_media)
+                            next_poll = time.time()
+            except Exception:
+                for upload in uploads:
+                    upload.cancel()
+                raise
+        if self.upload_stats:
+            LOG.info("Upload statistics: %s" % json.dumps(
+                self.upload_stats, sort_keys=True))
+
+        # The uploads are over, only the images are left
+        if watcher.pending:
+            LOG.info("Checking the image(s) status")
+        while watcher.pending:
+            self._check_cancelled(names)
+            delay = next_poll - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._update_images_status(watcher, medias_by_id)
+            next_poll = time.time() + watcher.interval
+
+    def _upload_media(self, local_media):
+        """Generate a media, convert it if needed and upload it in Glance.
+
+        Glance can't resume an upload: after a communication error, the
+        half-created image is deleted and the upload starts again, following
+        the `upload_retry` provider parameter (see
+        mincer.utils.retry.RetryPolicy).
+        """
+        self._check_cancelled(local_media.name)
+        local_media.generate()
+        local_media.convert()
+        retry_policy = mincer.utils.retry.RetryPolicy(
+            **self.params.get('upload_retry', UPLOAD_RETRY))
+        last_error = None
+        for attempt in retry_policy.attempts():
+            self._check_cancelled(local_media.name)
+            image = self._glance.images.create(
+                name=local_media.name,
+                properties=local_media.glance_properties())
+            try:
+                self._upload_image_data(image, local_media)
+            except RETRYABLE_UPLOAD_ERRORS as e:
+                LOG.info("%s: upload failed: %s" % (local_media.name, e))
+                self._delete_image(image)
+                last_error = e
+                continue
+            except Exception:
+                self._delete_image(image)
+                raise
+            local_media.glance_id = image.id
+            return
+        six.raise_from(UploadError("Failed to upload %s: %s" % (
+            local_media.name, last_error)), last_error)
+
+    def _upload_image_data(self, image, local_media):
+        """Push the content of a media in its image."""
+        if local_media.copy_from:
+            LOG.info("Downloading '%s' from %s" % (local_media.name,
+                                                  local_media.copy_from))
+            image.update(container_format='bare',
+                         disk_format=local_media.disk_format,
+                         copy_from=local_media.copy_from)
+            return
+
+        with open(local_media.getPath(), "rb") as media_fd:
+            LOG.info("Uploading %s to %s" % (local_media.getPath(),
+                                             local_media.name))
+            size = os.fstat(media_fd.fileno()).st_size
+            reader = mincer.utils.progress.ProgressReader(
+                media_fd, local_media.name, size=size,
+                cancelled=self._uploads_cancelled)
+            image.update(container_format='bare',
+                         disk_format=local_media.disk_format,
+                         data=reader)
+            self.upload_stats[local_media.name] = reader.summary()
+
+    def _delete_image(self, image):
+        """Delete a half-created image, the errors are only logged."""
+        try:
+            image.delete()
+        except Exception as e:
+            LOG.info("Failed to delete the image %s: %s" % (image.id, e))
+
+    def _update_images_status(self, watcher, medias_by_id):
+        """Fetch the status of the images being waited for.
+
+        The status of all the pending images is fetched with one listing.
+        The volume_id_<name> future of a media is resolved once its image
+        is active. A killed image, or an image which keeps a status for too
+        long, raises an ImageException. The time limit of each status comes
+        from the `image_stuck_timeouts` provider parameter, e.g.
+        {'queued': 300, 'saving': 7200}, see image_watcher.STUCK_TIMEOUTS.
+
+        :param watcher: the watcher of the pending images
+        :type watcher: image_watcher.ImageWatcher
+        :param medias_by_id: the medias using each image
+        :type medias_by_id: dict
+        """
+        for image_id, image in watcher.update().items():
+            LOG.info("Image %s is ready" % image.name)
+            for local_media in medias_by_id[image_id]:
+                name = 'volume_id_%s' % local_media.name
+                self.medias[name] = image_id
+                if name in self._images and not self._images[name].done():
+                    self._images[name].set_result(image_id)
+        for image_id, status in list(watcher.failed.items()) + list(
+                watcher.stuck().items()):
+            raise ImageException("Error while waiting for image %s (%s): %s"
+                                 % (medias_by_id[image_id][0].name,
+                                    image_id, status))
+        if watcher.pending:
+            LOG.info("waiting for %s" % ", ".join(sorted(
+                medias_by_id[image_id][0].name
+                for image_id in watcher.pending)))
 
     def _register_pub_key(self, test_public_key):
         """Register the public key in the provider
@@ -457,7 +732,7 @@ resources:
         return dict(static_reserved_floating_ips,
                     **dynamic_reserved_floating_ips)
 
-    def _run(self, cmd_tpl, host=None):
+    def _run(self, cmd_tpl, host=None, log_output=True, output_callback=None):
         """Call a command on a host
 
         You can use this method to call a command on a remote host. $foo
@@ -470,6 +745,12 @@ resources:
         :type cmd_tpl: str
         :param host: the name of the target host
         :type host: str
+        :param log_output: log the output of the command, it is always
+         logged if the command fails
+        :type log_output: bool
+        :param output_callback: a function called with each new piece of
+         output while the command is running, and with None at the end
+        :type output_callback: function
         :return: a tuple with the returned code and the output
         """
         cmd = self._expand_template(cmd_tpl)
@@ -484,7 +765,7 @@ resources:
                           host)
                 raise ActionFailure()
 
-        session = self.ssh_client().get_transport(host_ip).open_session()
+        session = self.ssh_client().open_session(host_ip)
 
         session.set_combine_stderr(True)
         session.get_pty()
@@ -492,22 +773,40 @@ resources:
 
         session.exec_command(cmd)
 
-        output = ''
-        while not session.exit_status_ready():
-            if session.recv_ready():
-                data = session.recv(1024)
-                output += data
+        # Block on the channel until some data or the exit status arrive
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        chunks = []
+
+        def receive():
+            data = decoder.decode(session.recv(RECV_BUFFER_SIZE))
+            chunks.append(data)
+            if output_callback:
+                output_callback(data)
 
-                if session.recv_stderr_ready():
-                    LOG.info(session.recv_stderr(1024))
+        while True:
+            if session.recv_ready():
+                receive()
+            elif session.exit_status_ready():
+                break
+            else:
+                select.select([session], [], [], SELECT_TIMEOUT)
+        # The last output may arrive along with the exit status
+        while session.recv_ready():
+            receive()
+        chunks.append(decoder.decode(b'', final=True))
+        if output_callback:
+            output_callback(None)
+        output = ''.join(chunks)
         retcode = session.recv_exit_status()
 
-        LOG.info((
-            "command {cmd} output: {output}"
-        ).format(
-            cmd=cmd,
-            output=output
-        ))
+        if log_output or retcode != 0:
+            LOG.info((
+                "{host}command {cmd} output: {output}"
+            ).format(
+                host="%s: " % host if host else "",
+                cmd=cmd,
+                output=output
+            ))
         session.close()
         if retcode != 0:
             LOG.error((
@@ -520,11 +819,53 @@ resources:
             raise ActionFailure()
         return (retcode, output)
 
+    def _line_logger(self, prefix):
+        """Return an output callback which logs the output line by line.
+
+        :param prefix: the prefix of the log entries
+        :type prefix: str
+        :return: a function suitable for the output_callback of _run()
+        """
+        pending = ['']
+
+        def log_lines(data):
+            if data is None:
+                lines, pending[0] = [pending[0]] if pending[0] else [], ''
+            else:
+                lines = (pending[0] + data).split('\n')
+                pending[0] = lines.pop()
+            for line in lines:
+                LOG.info("%s%s" % (prefix, line.rstrip('\r')))
+        return log_lines
+
+    def _run_host_commands(self, host, commands, stream_output=True):
+        """Call a list of commands on a host, in order.
+
+        :param host: the name of the target host
+        :type host: str
+        :param commands: the command templates
+        :type commands: list
+        :param stream_output: log the output lines as soon as they arrive
+        :type stream_output: bool
+        :return: a list of (command template, output) tuples
+        :rtype: list
+        """
+        results = []
+        for command in commands:
+            output_callback = None
+            if stream_output:
+                output_callback = self._line_logger("%s: " % host)
+            retcode, output = self._run(command, host=host,
+                                        log_output=False,
+                                        output_callback=output_callback)
+            results.append((command, output))
+        return results
+
     def _register_check(self, cmd_tpl, interval=5):
         """Register a background check in the provider."""
         cmd = self._expand_template(cmd_tpl)
 
-        session = self.ssh_client().get_transport().open_session()
+        session = self.ssh_client().open_session()
         session.set_combine_stderr(True)
         session.get_pty()
         session.setblocking(0)
@@ -538,7 +879,11 @@ resources:
         })
 
     def watch_running_checks(self):
-        """Watch the status of the running background checks."""
+        """Watch the status of the running background checks.
+
+        The failure of a background upload is raised too.
+        """
+        self._check_uploads()
         for check_session in self._check_sessions:
             if 'session' not in check_session:
                 continue
@@ -567,7 +912,8 @@ resources:
         """Start the application infrastructure
 
         Start the application and gateway stacks and initialize the SSH
-        transport.
+        transport. Each stack is created once the images it references are
+        active: the gateway doesn't wait for the application images.
         """
         t0 = time.time()
         # Create the gateway stack
@@ -587,15 +933,19 @@ resources:
             application_id = self._create_or_update_stack(
                 name=self.name + "_app",
                 template_path=stack_file.name)
-            success_status = ['COMPLETE', 'CREATE_COMPLETE']
-            stack = self._wait_for_status_changes(tester_id, success_status)
+
+        # Both stacks are being created, wait for them together
+        success_status = ['COMPLETE', 'CREATE_COMPLETE']
+        stacks = self._wait_for_stacks([tester_id, application_id],
+                                       success_status)
+
+        stack = stacks[tester_id]
         logs = {}
         for output in stack.outputs:
             logs[output['output_key']] = six.StringIO(output['output_value'])
         self._tester_stack = Stack(tester_id, logs)
 
-        logs = {}
-        stack = self._wait_for_status_changes(application_id, success_status)
+        stack = stacks[application_id]
         info = ('stack creation processed in %.2f, final status: %s' %
                 (time.time() - t0, stack.status))
         LOG.info(info)
@@ -610,7 +960,7 @@ resources:
         gateway_ip = t['tester_instance_public_ip'].getvalue()
 
         self.ssh_client().start_transport(gateway_ip)
-        session = self.ssh_client().get_transport().open_session()
+        session = self.ssh_client().open_session()
         session.exec_command('uname -a')
 
         for host in self.get_machines():
@@ -663,15 +1013,19 @@ resources:
 
         return stack_params
 
+    def _stack_watcher(self, stack_id):
+        """Return the StackWatcher of a stack."""
+        if stack_id not in self._stack_watchers:
+            self._stack_watchers[stack_id] = stack_watcher.StackWatcher(
+                self._heat, stack_id)
+        return self._stack_watchers[stack_id]
+
     def _show_stack_progress(self, stack_id):
-            events = self._heat.events.list(stack_id)
-            created = set([item.resource_name for item in events if
-                           item.resource_status == 'CREATE_COMPLETE'])
-            creating = set([item.resource_name for item in events if
-                            item.resource_status == 'CREATE_IN_PROGRESS'])
+        watcher = self._stack_watcher(stack_id)
+        if watcher.update():
             LOG.info("%i: creating %s" %
-                     (len(created),
-                      ", ".join(creating - created)))
+                     (watcher.completed(),
+                      ", ".join(watcher.in_progress())))
 
     # TODO(Gonéri): Should be in the Stack class
     def _wait_for_status_changes(self, stack_id, expected_status):
@@ -683,19 +1037,47 @@ resources:
         :type expected_status: a array of strings
 
         """
-        for _ in six.moves.range(1, RETRY_MAX):
-            stack = self._heat.stacks.get(stack_id)
-            if stack.status in expected_status:
-                break
-            elif stack.status == 'FAILED':
-                LOG.error("Error while creating Stack: %s",
-                          stack.stack_status_reason)
-                raise StackCreationFailure()
-            self._show_stack_progress(stack_id)
-            time.sleep(2)
-        else:
-            raise StackTimeoutException("status: %s" % stack.status)
-        return stack
+        return self._wait_for_stacks([stack_id], expected_status)[stack_id]
+
+    def _wait_for_stacks(self, stack_ids, expected_status):
+        """Wait untill several stacks have a new status.
+
+        The stacks are watched together: the wait stops as soon as one of
+        them fails and the timeout applies to the slowest one. Only the new
+        events of the stacks are retrieved between two checks and the
+        polling interval grows while nothing happens. The timeout comes
+        from the `stack_timeout` provider parameter, in seconds.
+
+        :param stack_ids: The IDs of the stacks
+        :type stack_ids: list
+        :param expected_status: the exepected final status
+        :type expected_status: a array of strings
+        :returns: the stacks indexed by ID
+        :rtype: dict
+
+        """
+        stacks = {}
+        pending = list(stack_ids)
+        deadline = time.time() + self.params.get('stack_timeout',
+                                                 STACK_TIMEOUT)
+        while True:
+            for stack_id in list(pending):
+                stack = self._heat.stacks.get(stack_id)
+                if stack.status in expected_status:
+                    stacks[stack_id] = stack
+                    pending.remove(stack_id)
+                elif stack.status == 'FAILED':
+                    LOG.error("Error while creating Stack: %s",
+                              stack.stack_status_reason)
+                    raise StackCreationFailure()
+                else:
+                    self._show_stack_progress(stack_id)
+            if not pending:
+                return stacks
+            if time.time() >= deadline:
+                raise StackTimeoutException("status: %s" % stack.status)
+            time.sleep(min(self._stack_watcher(stack_id).interval
+                           for stack_id in pending))
 
     def _create_or_update_stack(self,
                                name=None,
@@ -731,6 +1113,7 @@ resources:
         tpl_files, template = template_utils.get_template_contents(
             template_path
         )
+        self._wait_for_images(template)
         stack_params = self._get_stack_parameters(
             tpl_files,
             template,
@@ -767,24 +1150,54 @@ resources:
         self._heat.stacks.delete(stack_id)
 
     def cleanup(self):
-        """Clean up the tenant."""
+        """Clean up the tenant.
+
+        The background uploads are cancelled first, their errors are
+        only logged.
+        """
+        self._uploads_cancelled.set()
+        futures.wait(self._uploads)
+        for upload in self._uploads:
+            if upload.exception():
+                LOG.info("Background upload stopped: %s" %
+                         upload.exception())
         if self._tester_stack:
             self.delete_stack(self._tester_stack.get_id())
         if self._application_stack:
             self.delete_stack(self._application_stack.get_id())
         if self._novaclient:
             self._novaclient.keypairs.delete(self.name)
+        if self._ssh_client:
+            self._ssh_client.close()
 
     def get_machines(self):
         """Collect machine informations from a running stack.
 
+        The result is cached for the current application stack, until
+        invalidate_machines() is called.
+
         :returns: a list of dictionnary describing the machines from
          the running stack
         :rtype: dict
         """
+        stack_id = self._application_stack.get_id()
+        if self._machines is None or self._machines_stack_id != stack_id:
+            self._machines = self._list_machines(stack_id)
+            self._machines_stack_id = stack_id
+        return self._machines
+
+    def invalidate_machines(self):
+        """Drop the cached machine inventory.
+
+        This method has to be called when the application stack changes.
+        """
+        self._machines = None
+        self._machines_stack_id = None
+
+    def _list_machines(self, stack_id):
+        """Retrieve the machines of a stack from Heat and Nova."""
         machines = {}
-        for resource in self._heat.resources.list(
-                self._application_stack.get_id()):
+        for resource in self._heat.resources.list(stack_id):
             if resource.resource_type != "OS::Nova::Server":
                 continue
             server = self._novaclient.servers.get(
@@ -817,17 +1230,47 @@ resources:
             raise mincer.exceptions.InstanceNameFromTemplateNotFoundInStack()
         return cmd
 
-    def run_commands(self, description, user, commands, hosts=None, **kwargs):
+    def run_commands(self, description, user, commands, hosts=None,
+                     parallel=1, output='stream', **kwargs):
         """Action to run commands on hosts.
 
         If the hosts key is not defined, the command is called from the
         gateway machine.
+
+        Up to `parallel` hosts are handled at the same time, the commands
+        of a given host are always called in order. By default, the output
+        lines are logged as soon as they arrive. With `output: ordered`,
+        the outputs are logged host after host, following the hosts list.
         """
         LOG.info(description)
         hosts = hosts or [None]
-        for host in hosts:
-            for command in commands:
-                self._run(command, host=host)
+        if parallel <= 1 or len(hosts) == 1:
+            for host in hosts:
+                for command in commands:
+                    self._run(command, host=host)
+            return
+
+        # Fill the machine inventory before the fan-out
+        self.get_machines()
+        stream_output = output != 'ordered'
+        workers = min(parallel, len(hosts))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            runs = [executor.submit(self._run_host_commands,
+                                    host, commands, stream_output)
+                    for host in hosts]
+            try:
+                if stream_output:
+                    for run in futures.as_completed(runs):
+                        run.result()
+                else:
+                    for host, run in zip(hosts, runs):
+                        for command, cmd_output in run.result():
+                            LOG.info("%s: command %s output: %s" % (
+                                host, command, cmd_output))
+            except Exception:
+                for run in runs:
+                    run.cancel()
+                raise
 
     def background_check(self, description, params, **kwargs):
         """Action to run a script on the local machine."""
@@ -856,14 +1299,20 @@ resources:
                                      template_path=heat_file)
         self._wait_for_status_changes(self._application_stack.get_id(),
                                       ['COMPLETE'])
+        # the servers may have changed during the update
+        self.invalidate_machines()
 
     def upload_images(self, description, medias, **kwargs):
-        """Upload medias of the application."""
+        """Upload medias of the application.
+
+        The uploads continue in the background, the next stacks are
+        created as soon as the images they reference are active.
+        """
         LOG.info(description)
         medias_objects = {}
         for k, v in six.iteritems(medias):
             medias_objects[k] = media.Media(k, v)
-        self.upload(medias_objects, CONF.refresh_medias)
+        self.upload(medias_objects, CONF.refresh_medias, wait=False)
 
 
 class Stack(object):
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Follow the progression of a stack from its events."""
+
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# Bounds of the polling interval, in seconds
+POLL_INTERVAL_MIN = 1
+POLL_INTERVAL_MAX = 10
+# Growth of the polling interval when nothing happens
+POLL_BACKOFF = 1.5
+
+
+class StackWatcher(object):
+
+    """Keep track of the resources of a stack.
+
+    Only the events newer than the last seen one are fetched from Heat,
+    the state of each resource is kept in memory.
+    """
+
+    def __init__(self, heat, stack_id):
+        """StackWatcher constructor
+
+        :param heat: the Heat client
+        :type heat: heatclient.v1.client.Client
+        :param stack_id: the ID of the stack to watch
+        :type stack_id: str
+        :returns: None
+        :rtype: None
+
+        """
+        self._heat = heat
+        self.stack_id = stack_id
+        self.resources = {}
+        self.interval = POLL_INTERVAL_MIN
+        self._marker = None
+
+    def update(self):
+        """Fetch the new events and update the state of the resources.
+
+        The polling interval is reset when something happened and grows
+        otherwise.
+
+        :returns: the number of new events
+        :rtype: int
+
+        """
+        kwargs = {'sort_dir': 'asc'}
+        if self._marker:
+            kwargs['marker'] = self._marker
+        events = self._heat.events.list(self.stack_id, **kwargs)
+        for event in events:
+            self.resources[event.resource_name] = event.resource_status
+            self._marker = event.id
+
+        if events:
+            self.interval = POLL_INTERVAL_MIN
+        else:
+            self.interval = min(self.interval * POLL_BACKOFF,
+                                POLL_INTERVAL_MAX)
+        return len(events)
+
+    def in_progress(self):
+        """Return the sorted names of the resources in progress."""
+        return sorted(name for name, status in self.resources.items()
+                      if status.endswith('_IN_PROGRESS'))
+
+    def completed(self):
+        """Return the number of completed resources."""
+        return len([status for status in self.resources.values()
+                    if status.endswith('_COMPLETE')])
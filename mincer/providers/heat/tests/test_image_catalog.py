@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+import testtools
+
+from mincer.providers.heat import image_catalog
+
+
+def _image(image_id, name, status='active', disk_format='qcow2',
+           checksum=None, size=0, properties=None):
+    image = mock.Mock()
+    image.properties = properties or {}
+    image.id = image_id
+    image.name = name
+    image.status = status
+    image.disk_format = disk_format
+    image.checksum = checksum
+    image.size = size
+    return image
+
+
+class TestImageCatalog(testtools.TestCase):
+
+    def setUp(self):
+        super(TestImageCatalog, self).setUp()
+        self.images = [
+            _image(1, 'base', checksum='abc', size=10),
+            _image(2, 'base', checksum='def', size=10),
+            _image(3, 'base', status='killed'),
+            _image(4, 'iso', disk_format='iso', checksum='abc'),
+            _image(5, 'data', disk_format='raw',
+                   properties={'mincer_digest': '0123'})]
+        self.catalog = image_catalog.ImageCatalog(self.images)
+
+    def test_from_glance_lists_once(self):
+        glance = mock.Mock()
+        glance.images.list.return_value = self.images
+        catalog = image_catalog.ImageCatalog.from_glance(glance)
+        self.assertEqual(4, len(catalog))
+        glance.images.list.assert_called_once_with()
+
+    def test_find(self):
+        self.assertEqual([1, 2], [i.id for i in
+                                  self.catalog.find('qcow2', name='base')])
+        self.assertEqual([2], [i.id for i in self.catalog.find(
+            'qcow2', name='base', checksum='def')])
+        self.assertEqual([4], [i.id for i in self.catalog.find(
+            'iso', checksum='abc')])
+        self.assertEqual([], self.catalog.find('raw', name='base'))
+
+    def test_inactive_images_are_ignored(self):
+        self.assertEqual([1, 2], [i.id for i in self.catalog.find('qcow2')])
+
+    def test_find_media(self):
+        local_media = mock.Mock()
+        local_media.disk_format = 'qcow2'
+        local_media.name = 'base'
+        local_media.size = 10
+        local_media.filter_on = ['name', 'size']
+        self.assertEqual(2, self.catalog.find_media(local_media).id)
+
+        local_media.filter_on = ['checksum']
+        local_media.checksum = 'abc'
+        self.assertEqual(1, self.catalog.find_media(local_media).id)
+
+        local_media.checksum = 'nope'
+        self.assertIsNone(self.catalog.find_media(local_media))
+
+    def test_find_media_from_sources(self):
+        local_media = mock.Mock()
+        local_media.disk_format = 'raw'
+        local_media.digest = '0123'
+        local_media.filter_on = ['sources']
+        self.assertEqual(5, self.catalog.find_media(local_media).id)
+
+        local_media.digest = '4567'
+        self.assertIsNone(self.catalog.find_media(local_media))
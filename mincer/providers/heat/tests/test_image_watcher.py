@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import glanceclient.exc
+import mock
+import testtools
+
+from mincer.providers.heat import image_watcher
+
+
+def _image(image_id, status):
+    image = mock.Mock()
+    image.id = image_id
+    image.status = status
+    return image
+
+
+class TestImageWatcher(testtools.TestCase):
+
+    def setUp(self):
+        super(TestImageWatcher, self).setUp()
+        self.glance = mock.Mock()
+        self.glance.images.list.return_value = [
+            _image(1, 'active'), _image(2, 'saving'), _image(3, 'killed'),
+            _image(4, 'active')]
+        self.watcher = image_watcher.ImageWatcher(self.glance, [1, 2, 3])
+
+    def test_update(self):
+        self.assertEqual([1], list(self.watcher.update()))
+        self.assertEqual(set([2]), self.watcher.pending)
+        self.assertEqual({3: 'killed'}, self.watcher.failed)
+        self.assertEqual(image_watcher.POLL_INTERVAL_MIN,
+                         self.watcher.interval)
+
+        self.assertEqual({}, self.watcher.update())
+        self.assertGreater(self.watcher.interval,
+                           image_watcher.POLL_INTERVAL_MIN)
+        self.glance.images.list.assert_called_with()
+        self.assertFalse(self.glance.images.get.called)
+
+    def test_watch(self):
+        self.watcher.update()
+        self.watcher.update()
+        self.watcher.watch(4)
+        self.assertEqual(set([2, 4]), self.watcher.pending)
+        self.assertEqual(image_watcher.POLL_INTERVAL_MIN,
+                         self.watcher.interval)
+        self.assertEqual([4], list(self.watcher.update()))
+
+    def test_image_not_listed(self):
+        self.glance.images.list.return_value = []
+        self.glance.images.get.side_effect = [
+            _image(1, 'active'), _image(2, 'queued'),
+            glanceclient.exc.HTTPNotFound()]
+        self.assertEqual([1], list(self.watcher.update()))
+        self.assertEqual({3: 'deleted'}, self.watcher.failed)
+
+    @mock.patch.object(image_watcher, 'time')
+    def test_stuck(self, mock_time):
+        mock_time.time.return_value = 100
+        watcher = image_watcher.ImageWatcher(self.glance, [2])
+        watcher.update()
+        # a long upload is not stuck by default
+        mock_time.time.return_value = 100 + 36000
+        self.assertEqual({}, watcher.stuck())
+
+        mock_time.time.return_value = 100
+        watcher = image_watcher.ImageWatcher(self.glance, [2],
+                                             {'saving': 3600})
+        watcher.update()
+        self.assertEqual({}, watcher.stuck())
+        mock_time.time.return_value = 100 + 3601
+        self.assertEqual({2: 'saving'}, watcher.stuck())
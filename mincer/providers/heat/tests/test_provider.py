@@ -14,9 +14,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import itertools
 import tempfile
+import threading
+import time
 
+from concurrent import futures
 import fixtures
+import glanceclient.exc
 import heatclient
 import keystoneclient.exceptions as keystoneexc
 import mock
@@ -25,6 +30,7 @@ import six
 import testtools
 
 import mincer.exceptions
+from mincer import media
 import mincer.providers.heat. provider as provider
 
 provider.LOG = mock.Mock()
@@ -52,6 +58,26 @@ description: >
 """)
 
 
+def fake_image(name, image_id=None, status='active'):
+    image = mock.Mock(id=image_id or name, status=status)
+    image.name = name
+    return image
+
+
+def fake_glance(*images):
+    # the created images are listed as active at once
+    glance = mock.Mock()
+    images = list(images)
+
+    def create(name, properties):
+        images.append(fake_image(name))
+        return images[-1]
+
+    glance.images.create.side_effect = create
+    glance.images.list.side_effect = lambda: list(images)
+    return glance
+
+
 class TestProvider(testtools.TestCase):
 
     def setUp(self):
@@ -122,8 +148,8 @@ class TestProvider(testtools.TestCase):
         mystack = mock.Mock()
         mystack.outputs = [{'output_key': 'stdout',
                             'output_value': 'my output'}]
-        my_provider._wait_for_status_changes = \
-            mock.Mock(return_value=mystack)
+        my_provider._wait_for_stacks = \
+            mock.Mock(return_value={1: mystack})
         heatclient.common.template_utils.get_template_contents = mock.Mock()
         heatclient.common.template_utils.get_template_contents.return_value = (
             {'a': 'b'}, 'c')
@@ -131,6 +157,8 @@ class TestProvider(testtools.TestCase):
             "a Heat stack template"), None)
         self.assertTrue(my_provider._tester_stack)
         self.assertTrue(my_provider._application_stack)
+        my_provider._wait_for_stacks.assert_called_once_with(
+            [1, 1], ['COMPLETE', 'CREATE_COMPLETE'])
 
     def test_register_floating_ips(self):
         my_provider = provider.Heat(args=fake_args())
@@ -244,6 +272,23 @@ class TestProvider(testtools.TestCase):
             }}
         self.assertEqual(reference, my_provider.get_machines())
 
+        # the inventory is cached
+        self.assertEqual(reference, my_provider.get_machines())
+        self.assertEqual(1, my_provider._heat.resources.list.call_count)
+        self.assertEqual(1, my_provider._novaclient.servers.get.call_count)
+
+        # until it is invalidated
+        my_provider.invalidate_machines()
+        mock_server.interface_list.return_value = [mock_iface]
+        self.assertEqual(reference, my_provider.get_machines())
+        self.assertEqual(2, my_provider._heat.resources.list.call_count)
+
+        # or the application stack changes
+        my_provider._application_stack = provider.Stack("paul", {})
+        mock_server.interface_list.return_value = [mock_iface]
+        my_provider.get_machines()
+        my_provider._heat.resources.list.assert_called_with("paul")
+
     def test_filter_medias(self):
         my_provider = provider.Heat(args=fake_args())
         my_provider._glance = mock.Mock()
@@ -280,6 +325,7 @@ class TestProvider(testtools.TestCase):
                          {'volume_id_name_1': None}.keys())  # Py34
 
         my_provider.medias = {}
+        my_provider._glance.images.list.return_value = [mock_image_3]
         my_provider._glance.images.get.return_value = mock_image_3
         medias = {"name_1": mock_image_1}
         self.assertRaises(provider.ImageException,
@@ -393,14 +439,165 @@ class TestProvider(testtools.TestCase):
         to_up = my_provider._filter_medias(images_to_upload, [])
         self.assertEqual(to_up['name_1'].glance_id, None)
 
+    def test_upload_deduplicates_the_medias(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._glance = mock.Mock()
+        image = my_provider._glance.images.create.return_value
+        image.id = 'abc'
+        image.status = 'active'
+        my_provider._glance.images.list.side_effect = [[], [image]]
+        description = {'type': 'remote', 'disk_format': 'qcow2',
+                       'copy_from': 'http://my.mirror/ubuntu-vm.qcow2'}
+        medias = {'jenkins_image': media.Media('jenkins_image', description),
+                  'base_image': media.Media('base_image', description)}
+        my_provider.upload(medias, [])
+        my_provider._glance.images.create.assert_called_once_with(
+            name='base_image', properties={})
+        self.assertEqual({'volume_id_base_image': 'abc',
+                          'volume_id_jenkins_image': 'abc'},
+                         my_provider.medias)
+
+    def test_upload_refreshes_a_duplicate(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._glance = mock.Mock()
+        old_image = mock.Mock(id='old', status='active', disk_format='qcow2')
+        old_image.name = 'jenkins_image'
+        image = my_provider._glance.images.create.return_value
+        image.id = 'abc'
+        image.status = 'active'
+        my_provider._glance.images.list.side_effect = itertools.chain(
+            [[old_image]], itertools.repeat([old_image, image]))
+        description = {'type': 'remote', 'disk_format': 'qcow2',
+                       'copy_from': 'http://my.mirror/ubuntu-vm.qcow2'}
+        medias = {'jenkins_image': media.Media('jenkins_image', description),
+                  'base_image': media.Media('base_image', description)}
+        with mock.patch.object(media, 'deduplicate',
+                               wraps=media.deduplicate) as deduplicate:
+            my_provider.upload(medias, ['base_image'])
+        # the media found in Glance is not compared
+        deduplicate.assert_called_once_with([medias['base_image']])
+        my_provider._glance.images.create.assert_called_once_with(
+            name='base_image', properties={})
+        self.assertEqual({'volume_id_base_image': 'abc',
+                          'volume_id_jenkins_image': 'old'},
+                         my_provider.medias)
+
+    def test_upload_in_background(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._upload_and_wait = mock.Mock()
+        my_provider.upload({'base_image': mock.Mock()}, [], wait=False)
+        futures.wait(my_provider._uploads)
+        my_provider._upload_and_wait.assert_called_once_with(
+            {'base_image': mock.ANY}, [])
+        self.assertEqual(['volume_id_base_image'],
+                         list(my_provider._images))
+        my_provider.watch_running_checks()
+
+    def test_upload_in_background_failure(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._filter_medias = mock.Mock(
+            side_effect=provider.UploadError())
+        my_provider.upload({'base_image': mock.Mock()}, [], wait=False)
+        futures.wait(my_provider._uploads)
+        self.assertIsInstance(
+            my_provider._images['volume_id_base_image'].exception(),
+            provider.UploadError)
+        self.assertRaises(provider.UploadError,
+                          my_provider.watch_running_checks)
+
+    def test_wait_for_uploads(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._filter_medias = mock.Mock(
+            side_effect=provider.UploadError())
+        my_provider.upload({'base_image': mock.Mock()}, [], wait=False)
+        self.assertRaises(provider.UploadError,
+                          my_provider.wait_for_uploads)
+
+    def test_cleanup_cancels_the_uploads(self):
+        my_provider = provider.Heat(args=fake_args())
+        started = threading.Event()
+
+        def upload(medias, refresh_medias):
+            started.set()
+            while True:
+                my_provider._check_cancelled('base_image')
+                time.sleep(0.01)
+
+        my_provider._upload_and_wait = upload
+        my_provider.upload({'base_image': mock.Mock()}, [], wait=False)
+        started.wait()
+        my_provider.cleanup()
+        self.assertTrue(my_provider._uploads[0].done())
+        self.assertIsInstance(my_provider._uploads[0].exception(),
+                              provider.UploadError)
+
+    def test__wait_for_images(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._images = {'volume_id_base_image': futures.Future(),
+                               'volume_id_app_image': futures.Future()}
+        my_provider._images['volume_id_base_image'].set_result('abc')
+        my_provider._images['volume_id_app_image'].set_exception(
+            provider.ImageException())
+        # only the images referenced by the template are awaited
+        my_provider._wait_for_images({'parameters': {
+            'volume_id_base_image': {'type': 'string'},
+            'app_key_name': {'type': 'string'}}})
+        my_provider._wait_for_images({})
+        self.assertRaises(provider.ImageException,
+                          my_provider._wait_for_images,
+                          {'parameters': {'volume_id_app_image': {}}})
+        self.assertRaises(provider.ImageException,
+                          my_provider._wait_for_images, 'not parsed')
+
+    def test__upload_medias_resolves_the_images(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._glance = fake_glance(fake_image('base_image', 'abc'))
+        my_provider._images = {'volume_id_base_image': futures.Future()}
+        local_media = mock.Mock()
+        local_media.name = 'base_image'
+        local_media.glance_id = 'abc'
+        my_provider._upload_medias({'base_image': local_media})
+        self.assertEqual(
+            'abc', my_provider._images['volume_id_base_image'].result(0))
+
+    def test_upload_resolves_each_image_on_its_own(self):
+        my_provider = provider.Heat(params={'upload_workers': 2},
+                                    args=fake_args())
+        my_provider._glance = fake_glance()
+        my_provider._filter_medias = lambda medias, refresh_medias: medias
+        medias = {}
+        for name in ('app_image', 'base_image'):
+            medias[name] = mock.Mock()
+            medias[name].name = name
+            medias[name].glance_id = None
+            medias[name].needs_build.return_value = False
+        base_image_checked = threading.Event()
+
+        def upload_image_data(image, local_media):
+            # the upload of app_image is the slow one
+            if local_media.name == 'app_image':
+                base_image_checked.wait(10)
+
+        my_provider._upload_image_data = upload_image_data
+        my_provider.upload(medias, [], wait=False)
+        base_image = my_provider._images['volume_id_base_image']
+        app_image = my_provider._images['volume_id_app_image']
+        self.assertEqual('base_image', base_image.result(10))
+        self.assertFalse(app_image.done())
+        base_image_checked.set()
+        self.assertEqual('app_image', app_image.result(10))
+        my_provider.wait_for_uploads()
+
     def test__upload_medias_already_done(self):
         my_provider = provider.Heat(args=fake_args())
         my_media = mock.Mock()
         my_media.name = "Jim"
         my_media.glance_id = 123
         provider.LOG = mock.Mock()
+        my_provider._glance = fake_glance(fake_image('Jim', 123))
         my_provider._upload_medias({'my_media': my_media})
-        provider.LOG.info.assert_called_with('Jim already in Glance (123)')
+        provider.LOG.info.assert_any_call('Jim already in Glance (123)')
+        self.assertFalse(my_provider._glance.images.create.called)
 
     def test__upload_medias_with_copy_from(self):
         my_provider = provider.Heat(args=fake_args())
@@ -408,11 +605,13 @@ class TestProvider(testtools.TestCase):
         my_media.name = "Jim"
         my_media.copy_from = "http://somewhere"
         my_media.glance_id = None
+        my_media.needs_build.return_value = False
         provider.LOG = mock.Mock()
-        my_provider._glance = mock.Mock()
+        my_provider._glance = fake_glance()
         my_provider._upload_medias({'my_media': my_media})
-        provider.LOG.info.assert_called_with(
+        provider.LOG.info.assert_any_call(
             "Downloading 'Jim' from http://somewhere")
+        self.assertEqual({'volume_id_Jim': 'Jim'}, my_provider.medias)
 
     def test__upload_medias_with_local_image(self):
         my_provider = provider.Heat(args=fake_args())
@@ -420,52 +619,217 @@ class TestProvider(testtools.TestCase):
         my_media.name = "Jim"
         my_media.copy_from = None
         my_media.glance_id = None
+        my_media.needs_build.return_value = False
         provider.LOG = mock.Mock()
-        my_provider._glance = mock.Mock()
+        my_provider._glance = fake_glance()
         tf = tempfile.NamedTemporaryFile()
         my_media.getPath.return_value = tf.name
         my_provider._upload_medias({'my_media': my_media})
-        provider.LOG.info.assert_called_with(
+        provider.LOG.info.assert_any_call(
             'Uploading %s to Jim' % tf.name)
+        provider.LOG.info.assert_any_call(
+            'Upload statistics: {"Jim": {"bytes": 0, "duration": 0, '
+            '"rate": 0}}')
+
+    def test__upload_medias_concurrently(self):
+        my_provider = provider.Heat(params={'upload_workers': 2},
+                                    args=fake_args())
+        my_provider._glance = fake_glance()
+        tf = tempfile.NamedTemporaryFile()
+        medias = {}
+        for name in ('Jim', 'Kim', 'Tim'):
+            medias[name] = mock.Mock()
+            medias[name].name = name
+            medias[name].copy_from = None
+            medias[name].glance_id = None
+            medias[name].needs_build.return_value = False
+            medias[name].getPath.return_value = tf.name
+        my_provider._upload_medias(medias)
+        for my_media in medias.values():
+            my_media.generate.assert_called_once_with()
+            my_media.convert.assert_called_once_with()
+        self.assertEqual(3, my_provider._glance.images.create.call_count)
+        self.assertEqual(['Jim', 'Kim', 'Tim'],
+                         sorted(my_provider.upload_stats))
+
+    @mock.patch('mincer.media.generate_medias')
+    def test__upload_medias_builds_the_dynamic_medias_together(
+            self, mock_generate_medias):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._glance = fake_glance()
+        tf = tempfile.NamedTemporaryFile()
+        medias = {}
+        for name in ('Jim', 'Kim', 'Tim'):
+            medias[name] = mock.Mock()
+            medias[name].name = name
+            medias[name].copy_from = None
+            medias[name].glance_id = None
+            medias[name].needs_build.return_value = name != 'Tim'
+            medias[name].getPath.return_value = tf.name
+        my_provider._upload_medias(medias)
+        self.assertEqual(1, mock_generate_medias.call_count)
+        self.assertEqual(
+            ['Jim', 'Kim'],
+            sorted(m.name for m in mock_generate_medias.call_args[0][0]))
+        self.assertEqual(3, my_provider._glance.images.create.call_count)
+
+    @mock.patch('mincer.media.generate_medias', mock.Mock())
+    def test__upload_medias_uploads_the_dynamic_medias_at_once(self):
+        my_provider = provider.Heat(params={'upload_workers': 2},
+                                    args=fake_args())
+        my_provider._glance = fake_glance(fake_image('Jim'),
+                                          fake_image('Tim'))
+        medias = {}
+        for name in ('Jim', 'Tim'):
+            medias[name] = mock.Mock()
+            medias[name].name = name
+            medias[name].glance_id = None
+            medias[name].needs_build.return_value = name == 'Jim'
+        dynamic_uploaded = threading.Event()
+        uploaded = []
+
+        def upload_media(local_media):
+            # the static upload lasts until the dynamic one is done
+            if local_media.name == 'Tim':
+                dynamic_uploaded.wait(10)
+            else:
+                dynamic_uploaded.set()
+            local_media.glance_id = local_media.name
+            uploaded.append(local_media.name)
+
+        my_provider._upload_media = upload_media
+        my_provider._upload_medias(medias)
+        self.assertEqual(['Jim', 'Tim'], uploaded)
+
+    def test__upload_media_retries(self):
+        my_provider = provider.Heat(
+            params={'upload_retry': {'initial_delay': 0, 'max_attempts': 2}},
+            args=fake_args())
+        my_provider._glance = mock.Mock()
+        images = [mock.Mock(id=1), mock.Mock(id=2)]
+        my_provider._glance.images.create.side_effect = images
+        images[0].update.side_effect = glanceclient.exc.CommunicationError()
+        tf = tempfile.NamedTemporaryFile()
+        tf.write(b'Merguez' * 1000)
+        tf.flush()
+        uploaded = []
+        images[1].update.side_effect = lambda data=None, **kw: \
+            uploaded.append(data.read())
+        my_media = mock.Mock()
+        my_media.name = "Jim"
+        my_media.copy_from = None
+        my_media.getPath.return_value = tf.name
+        my_provider._upload_media(my_media)
+        images[0].delete.assert_called_once_with()
+        self.assertFalse(images[1].delete.called)
+        self.assertEqual(2, my_media.glance_id)
+        self.assertEqual([b'Merguez' * 1000], uploaded)
+        self.assertEqual(7000, my_provider.upload_stats['Jim']['bytes'])
+
+    def test__upload_media_gives_up(self):
+        my_provider = provider.Heat(
+            params={'upload_retry': {'initial_delay': 0, 'max_attempts': 2}},
+            args=fake_args())
+        my_provider._glance = mock.Mock()
+        image = my_provider._glance.images.create.return_value
+        image.update.side_effect = glanceclient.exc.HTTPServiceUnavailable()
+        my_media = mock.Mock()
+        my_media.name = "Jim"
+        my_media.copy_from = "http://somewhere"
+        my_media.glance_id = None
+        error = self.assertRaises(provider.UploadError,
+                                  my_provider._upload_media, my_media)
+        self.assertEqual('Failed to upload Jim: %s' %
+                         glanceclient.exc.HTTPServiceUnavailable(),
+                         str(error))
+        self.assertEqual(2, image.delete.call_count)
+        self.assertIsNone(my_media.glance_id)
+
+        image.update.side_effect = ValueError()
+        self.assertRaises(ValueError, my_provider._upload_media, my_media)
+        self.assertEqual(3, image.delete.call_count)
+
+    def test__upload_medias_failure(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._glance = mock.Mock()
+        my_media = mock.Mock()
+        my_media.name = "Jim"
+        my_media.glance_id = None
+        my_media.needs_build.return_value = False
+        my_media.generate.side_effect = provider.UploadError()
+        self.assertRaises(provider.UploadError,
+                          my_provider._upload_medias, {'Jim': my_media})
 
-    def test__wait_for_medias_in_glance(self):
+    def test__upload_medias_waits_for_the_images(self):
         my_provider = provider.Heat(args=fake_args())
         my_media = mock.Mock()
         my_media.name = 'Kim'
+        my_media.id = 123
         my_media.glance_id = 123
         my_provider._glance = mock.Mock()
-        my_provider._glance.images.get.return_value = my_media
-        my_provider._wait_for_medias_in_glance({})
+        my_provider._glance.images.list.return_value = [my_media]
+        my_provider._upload_medias({})
         self.assertEqual(my_provider.medias, {})
 
         my_provider.medias = {}
         provider.LOG = mock.Mock()
         my_media.status = 'active'
-        my_provider._wait_for_medias_in_glance({'bob': my_media})
+        my_provider._upload_medias({'bob': my_media})
         provider.LOG.info.assert_called_with(
             'Image Kim is ready')
+        self.assertEqual({'volume_id_Kim': 123}, my_provider.medias)
 
         my_provider.medias = {}
         my_media.status = 'killed'
-        my_provider._glance.images.get.return_value = my_media
         self.assertRaises(provider.ImageException,
-                          my_provider._wait_for_medias_in_glance,
+                          my_provider._upload_medias,
                           {'bob': my_media})
         provider.LOG.info.assert_called_with('Checking the image(s) status')
 
-    @mock.patch('time.sleep', mock.Mock())
-    def test__show_media_upload_status(self):
-        MB = 1024 * 1024
+    @mock.patch('time.sleep')
+    def test__upload_medias_lists_once_per_round(self, sleep):
         my_provider = provider.Heat(args=fake_args())
-        fd = mock.Mock()
-        fd.tell = mock.Mock()
-        fd.tell.side_effect = [6 * MB, 12 * MB]
-        provider.LOG = mock.Mock()
-        size = 12 * MB
-        my_provider._show_media_upload_status('foo', fd, size)
-        provider.LOG.info.assert_called_with('foo:     6M /   12M')
-        my_provider._show_media_upload_status('foo', fd, size)
-        provider.LOG.info.assert_called_with('foo:    12M /   12M')
+        images = []
+        medias = {}
+        for image_id, name in enumerate(('Jim', 'Kim', 'Tim'), 1):
+            image = mock.Mock()
+            image.id = image_id
+            image.name = name
+            image.status = 'saving'
+            images.append(image)
+            medias[name] = mock.Mock()
+            medias[name].name = name
+            medias[name].glance_id = image_id
+
+        def list_images():
+            # one more image is ready after each round
+            for image in images:
+                if image.status == 'saving':
+                    image.status = 'active'
+                    break
+            return images
+
+        my_provider._glance = mock.Mock()
+        my_provider._glance.images.list.side_effect = list_images
+        my_provider._upload_medias(medias)
+        self.assertEqual(3, my_provider._glance.images.list.call_count)
+        self.assertEqual(2, sleep.call_count)
+        self.assertFalse(my_provider._glance.images.get.called)
+        self.assertEqual({'volume_id_Jim': 1, 'volume_id_Kim': 2,
+                          'volume_id_Tim': 3}, my_provider.medias)
+
+    @mock.patch('time.sleep', mock.Mock())
+    @mock.patch('mincer.utils.ssh.SSH')
+    def test_ssh_client_retry_policy(self, ssh):
+        my_provider = provider.Heat(
+            params={'ssh_retry': {'deadline': 30, 'max_delay': 2}},
+            args=fake_args())
+        my_provider._priv_key = 'key'
+        my_provider._pub_key = 'pub'
+        self.assertEqual(ssh.return_value, my_provider.ssh_client())
+        retry_policy = ssh.call_args[1]['retry_policy']
+        self.assertEqual(30, retry_policy.deadline)
+        self.assertEqual(2, retry_policy.max_delay)
 
     def test_regiter_pub_key_ok(self):
         my_provider = provider.Heat(args=fake_args())
@@ -491,9 +855,62 @@ class TestProvider(testtools.TestCase):
         my_provider = provider.Heat(args=fake_args())
         my_provider.get_machines = mock.Mock(return_value={})
         my_provider.ssh_client = mock.Mock()
+        session = my_provider.ssh_client().open_session()
+        session.recv_ready.return_value = False
+        session.exit_status_ready.return_value = True
 
         self.assertRaises(provider.ActionFailure, my_provider._run, "toto")
 
+    @mock.patch('select.select')
+    def test_run_output(self, select):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider.get_machines = mock.Mock(return_value={})
+        my_provider.ssh_client = mock.Mock()
+        session = my_provider.ssh_client().open_session()
+        # two chunks, nothing for a while, the end of a UTF-8 character
+        session.recv_ready.side_effect = [True, True, False, True, False,
+                                          False]
+        session.recv.side_effect = [b'line 1\nline', b' 2 \xc3',
+                                    b'\xa9\n']
+        session.exit_status_ready.side_effect = [False, True]
+        session.recv_exit_status.return_value = 0
+        output_callback = mock.Mock()
+
+        self.assertEqual(
+            (0, u'line 1\nline 2 \xe9\n'),
+            my_provider._run("toto", output_callback=output_callback))
+        select.assert_called_once_with([session], [], [],
+                                       provider.SELECT_TIMEOUT)
+        self.assertEqual(
+            [mock.call(u'line 1\nline'), mock.call(u' 2 '),
+             mock.call(u'\xe9\n'), mock.call(None)],
+            output_callback.call_args_list)
+
+    def test_run_output_with_the_exit_status(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider.get_machines = mock.Mock(return_value={})
+        my_provider.ssh_client = mock.Mock()
+        session = my_provider.ssh_client().open_session()
+        # the output lands after recv_ready() was checked
+        session.recv_ready.side_effect = [False, True, False]
+        session.recv.side_effect = [b'done\n']
+        session.exit_status_ready.return_value = True
+        session.recv_exit_status.return_value = 0
+
+        self.assertEqual((0, u'done\n'), my_provider._run("toto"))
+
+    def test_line_logger(self):
+        my_provider = provider.Heat(args=fake_args())
+        provider.LOG = mock.Mock()
+        log_lines = my_provider._line_logger('host1: ')
+        log_lines('line 1\r\nline')
+        log_lines(' 2\nline 3')
+        log_lines(None)
+        self.assertEqual(
+            [mock.call('host1: line 1'), mock.call('host1: line 2'),
+             mock.call('host1: line 3')],
+            provider.LOG.info.call_args_list)
+
     def test_run_template_missing_value(self):
         my_provider = provider.Heat(args=fake_args())
         my_provider.get_machines = mock.Mock(return_value={})
@@ -595,10 +1012,13 @@ class TestProvider(testtools.TestCase):
         my_provider._heat.stacks.get.return_value = mock_stack
         my_provider._heat.events.list.return_value = []
         expected_status = ['CREATE_COMPLETE']
-        self.assertRaises(provider.StackTimeoutException,
-                          my_provider._wait_for_status_changes,
-                          1,
-                          expected_status)
+        # each call to the clock moves 10 minutes forward
+        with mock.patch('time.time',
+                        mock.Mock(side_effect=itertools.count(0, 600))):
+            self.assertRaises(provider.StackTimeoutException,
+                              my_provider._wait_for_status_changes,
+                              1,
+                              expected_status)
 
         mock_stack.status = 'CREATE_COMPLETE'
         my_provider._heat.stacks.get.return_value = mock_stack
@@ -616,6 +1036,40 @@ class TestProvider(testtools.TestCase):
                           1,
                           expected_status)
 
+    @mock.patch('time.sleep', mock.Mock())
+    def test_wait_for_stacks(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider._heat = mock.Mock()
+        my_provider._heat.events.list.return_value = []
+        stacks = {'gway': mock.Mock(), 'app': mock.Mock()}
+        stacks['gway'].status = 'IN_PROGRESS'
+        stacks['app'].status = 'COMPLETE'
+
+        def stacks_get(stack_id):
+            stack = stacks[stack_id]
+            # the gateway completes at the second check
+            if stack.status == 'IN_PROGRESS':
+                stack.status = 'COMPLETE'
+                return mock.Mock(status='IN_PROGRESS')
+            return stack
+
+        my_provider._heat.stacks.get.side_effect = stacks_get
+        self.assertEqual(
+            stacks,
+            my_provider._wait_for_stacks(['gway', 'app'], ['COMPLETE']))
+        # the app is not checked anymore once completed
+        self.assertEqual(3, my_provider._heat.stacks.get.call_count)
+
+        # a failure of one stack interrupts the wait
+        stacks['gway'].status = 'IN_PROGRESS'
+        stacks['app'].status = 'FAILED'
+        my_provider._heat.stacks.get.reset_mock()
+        my_provider._heat.stacks.get.side_effect = lambda i: stacks[i]
+        self.assertRaises(provider.StackCreationFailure,
+                          my_provider._wait_for_stacks,
+                          ['gway', 'app'], ['COMPLETE'])
+        self.assertEqual(2, my_provider._heat.stacks.get.call_count)
+
     def test_cleanup_not_connected(self):
         my_provider = provider.Heat(args=fake_args())
         self.assertEqual(my_provider.cleanup(), None)
@@ -654,6 +1108,43 @@ class TestProvider(testtools.TestCase):
         my_provider._run.assert_called_with(fake_commands[0],
                                             host=fake_hosts[0])
 
+    def test_run_commands_parallel(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider.get_machines = mock.Mock()
+        my_provider._run = mock.Mock(return_value=(0, 'ok'))
+        fake_commands = ["cmd1", "cmd2"]
+        fake_hosts = ["host1", "host2", "host3"]
+        provider.LOG = mock.Mock()
+        my_provider.run_commands("description", "user", fake_commands,
+                                 fake_hosts, parallel=2, output='ordered')
+
+        self.assertEqual(6, my_provider._run.call_count)
+        for host in fake_hosts:
+            host_calls = [c for c in my_provider._run.call_args_list
+                          if c[1]['host'] == host]
+            self.assertEqual(
+                [mock.call(command, host=host, log_output=False,
+                           output_callback=None)
+                 for command in fake_commands],
+                host_calls)
+        provider.LOG.info.assert_called_with(
+            'host3: command cmd2 output: ok')
+
+    def test_run_commands_parallel_failure(self):
+        my_provider = provider.Heat(args=fake_args())
+        my_provider.get_machines = mock.Mock()
+
+        def run(command, host, log_output, output_callback=None):
+            if host == 'host2':
+                raise provider.ActionFailure()
+            return (0, 'ok')
+
+        my_provider._run = mock.Mock(side_effect=run)
+        self.assertRaises(provider.ActionFailure,
+                          my_provider.run_commands,
+                          "description", "user", ["cmd1"],
+                          ["host1", "host2"], parallel=2)
+
     def test_background_check(self):
         my_provider = provider.Heat(args=fake_args())
         my_provider._register_check = mock.Mock()
@@ -699,6 +1190,7 @@ class TestProvider(testtools.TestCase):
             stack_id="fake_id", template_path="fake_heat_file.yaml")
         my_provider._wait_for_status_changes.assert_called_with(
             "fake_id", ['COMPLETE'])
+        self.assertIsNone(my_provider._machines)
 
     @mock.patch('mincer.providers.heat.provider.CONF')
     def test_upload_images(self, mock_CONF):
@@ -706,4 +1198,4 @@ class TestProvider(testtools.TestCase):
         my_provider.upload = mock.Mock()
         mock_CONF.refresh_medias = None
         my_provider.upload_images("description", {})
-        my_provider.upload.assert_called_with({}, None)
+        my_provider.upload.assert_called_with({}, None, wait=False)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+import testtools
+
+from mincer.providers.heat import stack_watcher
+
+
+def _event(event_id, resource_name, resource_status):
+    event = mock.Mock()
+    event.id = event_id
+    event.resource_name = resource_name
+    event.resource_status = resource_status
+    return event
+
+
+class TestStackWatcher(testtools.TestCase):
+
+    def setUp(self):
+        super(TestStackWatcher, self).setUp()
+        self.heat = mock.Mock()
+        self.watcher = stack_watcher.StackWatcher(self.heat, 'stack_id')
+
+    def test_update(self):
+        self.heat.events.list.return_value = [
+            _event('e1', 'port', 'CREATE_IN_PROGRESS'),
+            _event('e2', 'server', 'CREATE_IN_PROGRESS'),
+            _event('e3', 'port', 'CREATE_COMPLETE')]
+        self.assertEqual(3, self.watcher.update())
+        self.heat.events.list.assert_called_with('stack_id', sort_dir='asc')
+        self.assertEqual(['server'], self.watcher.in_progress())
+        self.assertEqual(1, self.watcher.completed())
+
+        self.heat.events.list.return_value = [
+            _event('e4', 'server', 'CREATE_COMPLETE')]
+        self.assertEqual(1, self.watcher.update())
+        self.heat.events.list.assert_called_with('stack_id', sort_dir='asc',
+                                                 marker='e3')
+        self.assertEqual([], self.watcher.in_progress())
+        self.assertEqual(2, self.watcher.completed())
+
+    def test_update_backoff(self):
+        self.heat.events.list.return_value = []
+        self.watcher.update()
+        self.assertEqual(stack_watcher.POLL_INTERVAL_MIN *
+                         stack_watcher.POLL_BACKOFF, self.watcher.interval)
+        for _ in range(20):
+            self.watcher.update()
+        self.assertEqual(stack_watcher.POLL_INTERVAL_MAX,
+                         self.watcher.interval)
+
+        self.heat.events.list.return_value = [
+            _event('e1', 'port', 'CREATE_IN_PROGRESS')]
+        self.watcher.update()
+        self.assertEqual(stack_watcher.POLL_INTERVAL_MIN,
+                         self.watcher.interval)
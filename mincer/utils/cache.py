@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Location of the persistent caches of the mincer."""
+
+import errno
+import os
+
+
+def cache_dir(*parts):
+    """Return a directory of the mincer cache, create it if needed.
+
+    The cache lives in $MINCER_CACHE_DIR, or in $XDG_CACHE_HOME/mincer
+    (~/.cache/mincer by default).
+
+    :param parts: the path of the directory inside the cache
+    :type parts: list of str
+    :returns: the path of the directory
+    :rtype: str
+
+    """
+    base_dir = os.environ.get('MINCER_CACHE_DIR')
+    if not base_dir:
+        base_dir = os.path.join(
+            os.environ.get('XDG_CACHE_HOME',
+                           os.path.expanduser('~/.cache')),
+            'mincer')
+    path = os.path.join(base_dir, *parts)
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Download the remote images in the mincer cache."""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+
+from concurrent import futures
+import six
+from six.moves.urllib import error as urllib_error
+from six.moves.urllib import parse as urllib_parse
+from six.moves.urllib import request as urllib_request
+
+from mincer.utils import cache
+from mincer.utils import fingerprint
+from mincer.utils import retry
+
+LOG = logging.getLogger(__name__)
+
+# Number of concurrent range requests
+FETCH_WORKERS = 4
+# Size of the range fetched by a request
+RANGE_SIZE = 32 * 1024 * 1024
+# Below this size, the file is fetched with a single request
+MIN_RANGE_SIZE = 2 * RANGE_SIZE
+# Size of the buffer used to write the files
+WRITE_BUFFER_SIZE = 1024 * 1024
+# Time limit of a network operation, in seconds
+SOCKET_TIMEOUT = 60
+# How a failed request is retried
+FETCH_RETRY = {'initial_delay': 2, 'max_delay': 30, 'max_attempts': 3}
+
+
+class FetchError(Exception):
+
+    """Raised when a file can't be downloaded."""
+
+
+def _open(url, method=None, headers=None):
+    """Send a request and return the response."""
+    request = urllib_request.Request(url, headers=headers or {})
+    if method:
+        request.get_method = lambda: method
+    return urllib_request.urlopen(request, timeout=SOCKET_TIMEOUT)
+
+
+def _copy(response, target):
+    """Write the body of a response in a file object, return its size."""
+    written = 0
+    while True:
+        chunk = response.read(WRITE_BUFFER_SIZE)
+        if not chunk:
+            return written
+        target.write(chunk)
+        written += len(chunk)
+
+
+class Fetcher(object):
+
+    """Download a remote file in the mincer cache.
+
+    A file which supports the range requests is fetched by RANGE_SIZE
+    pieces, FETCH_WORKERS at a time, a failed piece is retried alone. The
+    ranges are bound to the ETag of the file, the download fails if the
+    file changes in the middle.
+
+    The copy is kept in the cache with the validators of the server, the
+    next runs reuse it while the ETag, or the size and the modification
+    date, don't change. If the checksum of the file is known, a copy with
+    this checksum is reused without any request.
+    """
+
+    def __init__(self, url, workers=FETCH_WORKERS, retry_policy=None):
+        """Fetcher constructor
+
+        :param url: the HTTP URL of the file
+        :type url: str
+        :param workers: the number of concurrent range requests
+        :type workers: int
+        :param retry_policy: how a failed request is retried
+        :type retry_policy: mincer.utils.retry.RetryPolicy
+        :returns: None
+        :rtype: None
+
+        """
+        self.url = url
+        self.workers = workers
+        self.retry_policy = retry_policy or retry.RetryPolicy(**FETCH_RETRY)
+        directory = cache.cache_dir(
+            'downloads', hashlib.sha1(url.encode('utf-8')).hexdigest())
+        name = os.path.basename(urllib_parse.urlparse(url).path)
+        self.path = os.path.join(directory, name or 'download')
+        self._meta_path = os.path.join(directory, 'meta.json')
+
+    def fetch(self, checksum=None):
+        """Return the path to an up to date copy of the file.
+
+        :param checksum: the expected MD5 checksum of the file, or None
+        :type checksum: str
+        :returns: the path of the copy
+        :rtype: str
+
+        """
+        with self._lock():
+            if checksum and os.path.exists(self.path) and \
+                    fingerprint.checksum(self.path) == checksum:
+                LOG.info("%s: reusing the copy with the checksum %s" %
+                         (self.url, checksum))
+                return self.path
+
+            try:
+                remote = self._head()
+            except (urllib_error.URLError, IOError) as e:
+                if os.path.exists(self.path) and not checksum:
+                    LOG.warning("%s: unreachable (%s), reusing the "
+                                "copy in the cache" % (self.url, e))
+                    return self.path
+                raise FetchError("%s: unreachable: %s" % (self.url, e))
+
+            if not checksum and self._is_fresh(remote):
+                LOG.info("%s: the copy in the cache is up to date" %
+                         self.url)
+                return self.path
+
+            self._download(remote)
+            if checksum and fingerprint.checksum(self.path) != checksum:
+                os.unlink(self.path)
+                raise FetchError("%s: checksum mismatch, %s was expected" %
+                                 (self.url, checksum))
+            with open(self._meta_path, 'w') as f:
+                json.dump(remote, f)
+        return self.path
+
+    def _head(self):
+        """Return the size and the validators of the remote file."""
+        response = _open(self.url, method='HEAD')
+        try:
+            headers = response.info()
+            size = headers.get('Content-Length')
+            return {
+                'size': int(size) if size is not None else None,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'ranges': headers.get('Accept-Ranges') == 'bytes'}
+        finally:
+            response.close()
+
+    def _is_fresh(self, remote):
+        """Check the copy in the cache matches the remote file."""
+        if not os.path.exists(self.path) or \
+                not os.path.exists(self._meta_path):
+            return False
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        if remote['size'] != os.path.getsize(self.path):
+            return False
+        if remote['etag']:
+            return remote['etag'] == meta.get('etag')
+        return bool(remote['last_modified']) and \
+            remote['last_modified'] == meta.get('last_modified')
+
+    def _download(self, remote):
+        """Download the file next to its final location, then rename it."""
+        partial = self.path + '.part'
+        size = remote['size']
+        try:
+            if remote['ranges'] and size and size >= MIN_RANGE_SIZE:
+                self._fetch_ranges(partial, remote)
+            else:
+                self._fetch_whole(partial)
+            if size is not None and os.path.getsize(partial) != size:
+                raise FetchError("%s: %d bytes received, %d expected" % (
+                    self.url, os.path.getsize(partial), size))
+            os.rename(partial, self.path)
+        except Exception:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            raise
+
+    def _fetch_whole(self, partial):
+        """Download the file with a single request."""
+        LOG.info("Downloading %s" % self.url)
+        for attempt in self.retry_policy.attempts():
+            try:
+                response = _open(self.url)
+                try:
+                    with open(partial, 'wb') as f:
+                        _copy(response, f)
+                finally:
+                    response.close()
+                return
+            except (urllib_error.URLError, IOError) as e:
+                LOG.info("%s: download failed: %s" % (self.url, e))
+        raise FetchError("Failed to download %s" % self.url)
+
+    def _fetch_ranges(self, partial, remote):
+        """Download the file by ranges, concurrently."""
+        size = remote['size']
+        ranges = [(start, min(start + RANGE_SIZE, size) - 1)
+                  for start in six.moves.range(0, size, RANGE_SIZE)]
+        LOG.info("Downloading %s with %d range requests" % (self.url,
+                                                          len(ranges)))
+        with open(partial, 'wb') as f:
+            f.truncate(size)
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            jobs = [executor.submit(self._fetch_range, partial, remote,
+                                    start, end)
+                    for start, end in ranges]
+            done, not_done = futures.wait(
+                jobs, return_when=futures.FIRST_EXCEPTION)
+            for job in not_done:
+                job.cancel()
+            for job in done:
+                job.result()
+
+    def _fetch_range(self, partial, remote, start, end):
+        """Download a range of the file at its offset."""
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        if remote['etag']:
+            headers['If-Range'] = remote['etag']
+        for attempt in self.retry_policy.attempts():
+            try:
+                response = _open(self.url, headers=headers)
+                try:
+                    if response.getcode() != 206:
+                        raise FetchError(
+                            "%s: the file changed during the download" %
+                            self.url)
+                    with open(partial, 'r+b') as f:
+                        f.seek(start)
+                        written = _copy(response, f)
+                finally:
+                    response.close()
+                if written == end - start + 1:
+                    return
+                LOG.info("%s: range %d-%d truncated" % (self.url, start,
+                                                        end))
+            except (urllib_error.URLError, IOError) as e:
+                LOG.info("%s: range %d-%d failed: %s" % (self.url, start,
+                                                         end, e))
+        raise FetchError("Failed to download the range %d-%d of %s" %
+                         (start, end, self.url))
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Hold the file lock of the copy."""
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def fetch(url, checksum=None):
+    """Return the path to an up to date copy of a remote file.
+
+    :param url: the HTTP URL of the file
+    :type url: str
+    :param checksum: the expected MD5 checksum of the file, or None
+    :type checksum: str
+    :returns: the path of the copy in the mincer cache
+    :rtype: str
+
+    """
+    return Fetcher(url).fetch(checksum)
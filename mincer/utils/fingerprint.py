@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Checksum the files, remembering the result between the runs."""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import stat
+
+from mincer.utils import cache
+
+LOG = logging.getLogger(__name__)
+
+# Size of the buffer used to read the files
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+def md5sum(path):
+    """Return the MD5 checksum of a file.
+
+    The file is read through a fixed size buffer, whatever its size.
+
+    :param path: the path of the file
+    :type path: str
+    :returns: the hexadecimal digest
+    :rtype: str
+
+    """
+    md5 = hashlib.md5()
+    buf = bytearray(READ_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            md5.update(view[:size])
+    return md5.hexdigest()
+
+
+class FingerprintCache(object):
+
+    """A persistent cache of the file checksums.
+
+    An entry is identified by the path, the inode, the size and the
+    modification time of the file. If one of them changes, the file is
+    hashed again. The cache is only an optimization: if its database can't
+    be used, the error is logged and the files are hashed each time.
+    """
+
+    def __init__(self, db_path=None):
+        """FingerprintCache constructor
+
+        :param db_path: the location of the SQLite database, default is
+         fingerprints.sqlite in the mincer cache
+        :type db_path: str
+        :returns: None
+        :rtype: None
+
+        """
+        self.db_path = db_path
+        if not self.db_path:
+            try:
+                self.db_path = os.path.join(cache.cache_dir(),
+                                            'fingerprints.sqlite')
+            except OSError as e:
+                LOG.warning("The checksum cache is disabled: %s" % e)
+                return
+        self._execute("CREATE TABLE IF NOT EXISTS fingerprints ("
+                      "path TEXT PRIMARY KEY, inode INTEGER, "
+                      "size INTEGER, mtime REAL, md5 TEXT)")
+
+    def _execute(self, query, parameters=()):
+        """Run a query in its own transaction and return the first row.
+
+        A failure of the database is logged and disables the cache. None is
+        returned when the cache is disabled.
+        """
+        if not self.db_path:
+            return None
+        try:
+            db = sqlite3.connect(self.db_path, timeout=30)
+            try:
+                with db:
+                    return db.execute(query, parameters).fetchone()
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            LOG.warning("The checksum cache %s is disabled: %s" %
+                        (self.db_path, e))
+            self.db_path = None
+
+    def checksum(self, path):
+        """Return the MD5 checksum of a file.
+
+        :param path: the path of the file
+        :type path: str
+        :returns: the hexadecimal digest
+        :rtype: str
+
+        """
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        row = self._execute("SELECT inode, size, mtime, md5 "
+                            "FROM fingerprints WHERE path = ?", (path,))
+        if row and tuple(row[:3]) == key:
+            LOG.debug("%s: checksum found in the cache" % path)
+            return row[3]
+
+        LOG.debug("%s: computing the checksum" % path)
+        md5 = md5sum(path)
+        self._execute("INSERT OR REPLACE INTO fingerprints "
+                      "VALUES (?, ?, ?, ?, ?)", (path,) + key + (md5,))
+        return md5
+
+
+def checksum(path):
+    """Return the MD5 checksum of a file, using the default cache."""
+    return FingerprintCache().checksum(path)
+
+
+def tree_digest(path):
+    """Return a digest of a directory tree.
+
+    The digest covers the relative path, the kind and the content of each
+    entry of the tree. The checksums of the files come from the default
+    cache. The special files (pipes, sockets, devices) are never opened,
+    only their type and mode are covered.
+
+    :param path: the path of the directory
+    :type path: str
+    :returns: the hexadecimal SHA1 digest
+    :rtype: str
+
+    """
+    fingerprints = FingerprintCache()
+    sha = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            full_path = os.path.join(root, name)
+            rel_path = os.path.relpath(full_path, path)
+            mode = os.lstat(full_path).st_mode
+            if stat.S_ISLNK(mode):
+                entry = 'L %s %s' % (rel_path, os.readlink(full_path))
+            elif stat.S_ISDIR(mode):
+                entry = 'D %s' % rel_path
+            elif stat.S_ISREG(mode):
+                entry = 'F %s %o %s' % (rel_path, mode,
+                                        fingerprints.checksum(full_path))
+            else:
+                entry = 'S %s %o' % (rel_path, mode)
+            sha.update((entry + '\n').encode('utf-8'))
+    return sha.hexdigest()
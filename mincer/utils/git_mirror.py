@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Keep a local mirror of the remote Git repositories."""
+
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+
+from mincer.utils import cache
+from mincer.utils import processes
+
+LOG = logging.getLogger(__name__)
+
+# Default time limit of a clone or a fetch, in seconds
+FETCH_TIMEOUT = 3600
+
+
+class GitMirrorError(Exception):
+
+    """Raised when a Git operation fails."""
+
+
+def _run(cmd, timeout=None, group=None):
+    """Run a command and return its output.
+
+    :param cmd: the command to run
+    :type cmd: list
+    :param timeout: the time limit of the command in seconds, or None
+    :type timeout: float
+    :param group: the group of the process, see
+     mincer.utils.processes.ProcessGroup
+    :type group: mincer.utils.processes.ProcessGroup
+    :returns: the output of the command
+    :rtype: bytes
+
+    """
+    try:
+        returncode, output, error = processes.run(cmd, timeout, group)
+    except processes.ProcessTimeout as e:
+        raise GitMirrorError(str(e))
+    if returncode != 0:
+        raise GitMirrorError("'%s' failed with code %d: %s" %
+                             (' '.join(cmd), returncode,
+                              error.decode('utf-8', 'replace')))
+    return output
+
+
+class GitMirror(object):
+
+    """A bare mirror of a remote Git repository in the mincer cache.
+
+    The repository is cloned on first use, then only the new objects are
+    fetched, once per process. The content of a commit is exported with
+    git archive, without any .git directory.
+
+    The mirror is protected by a file lock: one process or thread updates
+    it while the others wait, several can read it at the same time. The
+    Git commands of an operation can be registered in a
+    mincer.utils.processes.ProcessGroup, to be killed with it.
+    """
+
+    # The mirrors already fetched by this process
+    _fetched = set()
+    _fetched_lock = threading.Lock()
+
+    def __init__(self, url):
+        """GitMirror constructor
+
+        :param url: the URL of the remote repository
+        :type url: str
+        :returns: None
+        :rtype: None
+
+        """
+        self.url = url
+        self.path = os.path.join(
+            cache.cache_dir('git'),
+            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def update(self, timeout=FETCH_TIMEOUT, group=None):
+        """Clone or fetch the remote repository.
+
+        :param timeout: the time limit in seconds
+        :type timeout: float
+        :param group: the group of the Git processes, or None
+        :type group: mincer.utils.processes.ProcessGroup
+        :returns: None
+        :rtype: None
+
+        """
+        with self._fetched_lock:
+            if self.path in self._fetched:
+                return
+        with self._lock(fcntl.LOCK_EX):
+            if os.path.exists(os.path.join(self.path, 'HEAD')):
+                LOG.info("Fetching '%s'" % self.url)
+                self._git(['fetch', '--prune', 'origin'], timeout, group)
+            else:
+                LOG.info("Cloning '%s'" % self.url)
+                try:
+                    _run(['git', 'clone', '--mirror', '--quiet',
+                          self.url, self.path], timeout, group)
+                except GitMirrorError:
+                    shutil.rmtree(self.path, ignore_errors=True)
+                    raise
+        with self._fetched_lock:
+            self._fetched.add(self.path)
+
+    def resolve(self, ref, timeout=FETCH_TIMEOUT, group=None):
+        """Return the commit behind a reference, after an update.
+
+        :param ref: a branch, a tag or a commit
+        :type ref: str
+        :param timeout: the time limit of the update in seconds
+        :type timeout: float
+        :param group: the group of the Git processes, or None
+        :type group: mincer.utils.processes.ProcessGroup
+        :returns: the SHA1 of the commit
+        :rtype: str
+
+        """
+        self.update(timeout, group)
+        with self._lock(fcntl.LOCK_SH):
+            try:
+                output = self._git(['rev-parse', '--verify',
+                                    '%s^{commit}' % ref])
+            except GitMirrorError:
+                raise GitMirrorError("Reference '%s' not found in '%s'" %
+                                     (ref, self.url))
+        return output.decode('utf-8').strip()
+
+    def export(self, commit, target_dir, timeout=None, group=None):
+        """Extract the content of a commit in a directory.
+
+        :param commit: the commit to export
+        :type commit: str
+        :param target_dir: the destination, it must exist
+        :type target_dir: str
+        :param timeout: the time limit in seconds, or None
+        :type timeout: float
+        :param group: the group of the Git process, or None
+        :type group: mincer.utils.processes.ProcessGroup
+        :returns: None
+        :rtype: None
+
+        """
+        cmd = ['git', '--git-dir', self.path, 'archive', '--format=tar',
+               commit]
+        with self._lock(fcntl.LOCK_SH):
+            process = processes.popen(cmd, stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+            try:
+                with processes.supervise(process, cmd, timeout, group):
+                    try:
+                        with tarfile.open(fileobj=process.stdout,
+                                          mode='r|') as tar:
+                            tar.extractall(target_dir)
+                    except tarfile.TarError as e:
+                        LOG.debug(e)
+                    finally:
+                        error = process.communicate()[1]
+            except processes.ProcessTimeout as e:
+                raise GitMirrorError(str(e))
+        if process.returncode != 0:
+            raise GitMirrorError("Failed to export %s from '%s': %s" %
+                                 (commit, self.url,
+                                  error.decode('utf-8', 'replace')))
+
+    def _git(self, args, timeout=None, group=None):
+        """Run a Git command in the mirror."""
+        return _run(['git', '--git-dir', self.path] + args, timeout, group)
+
+    @contextlib.contextmanager
+    def _lock(self, operation):
+        """Hold the file lock of the mirror."""
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
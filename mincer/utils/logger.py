@@ -49,9 +49,9 @@ class RotatingSwiftHandler(logging.handlers.MemoryHandler):
 
         """
         self.acquire()
-        if len(self.buffer) == 0:
-            return
         try:
+            if len(self.buffer) == 0:
+                return
             messages = "\n".join([lr.getMessage() for lr in self.buffer])
             self.swift_client.put_object(
                 self.container,
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Run the external commands with a time limit."""
+
+import contextlib
+import os
+import signal
+import subprocess
+import threading
+
+
+class ProcessTimeout(Exception):
+
+    """Raised when a command is killed after its time limit."""
+
+
+class ProcessGroup(object):
+
+    """The running processes of an operation, killed together on failure."""
+
+    def __init__(self):
+        """ProcessGroup constructor
+
+        :returns: None
+        :rtype: None
+
+        """
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def add(self, process):
+        """Register a running process."""
+        with self._lock:
+            self._processes.add(process)
+
+    def discard(self, process):
+        """Forget a finished process."""
+        with self._lock:
+            self._processes.discard(process)
+
+    def kill(self):
+        """Kill the processes still running."""
+        with self._lock:
+            for process in self._processes:
+                kill(process)
+
+
+def popen(cmd, **kwargs):
+    """Start a command in its own session.
+
+    The children of the command, e.g. the ones of a shell script, are in
+    the process group of the command and are killed along with it.
+
+    :param cmd: the command to run
+    :type cmd: list
+    :param kwargs: the other arguments of subprocess.Popen
+    :type kwargs: dict
+    :returns: the running process
+    :rtype: subprocess.Popen
+
+    """
+    # start_new_session is not available on Python 2.7
+    return subprocess.Popen(cmd, preexec_fn=os.setsid, **kwargs)
+
+
+def kill(process):
+    """Kill a process started by popen() and its children."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def supervise(process, cmd, timeout=None, group=None):
+    """Kill a process if it outlives its time limit.
+
+    The process must be started by popen(). It is registered in the group
+    while the block runs. If the time limit is reached, the process and its
+    children are killed and ProcessTimeout is raised at the end of the
+    block.
+
+    :param process: the running process, started by popen()
+    :type process: subprocess.Popen
+    :param cmd: the command of the process, for the error message
+    :type cmd: list
+    :param timeout: the time limit in seconds, or None
+    :type timeout: float
+    :param group: the group of the process, or None
+    :type group: ProcessGroup
+    :returns: a context manager
+    :rtype: contextlib.GeneratorContextManager
+
+    """
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        kill(process)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+    if group:
+        group.add(process)
+    try:
+        yield
+    finally:
+        if timer:
+            timer.cancel()
+        if group:
+            group.discard(process)
+        if timed_out.is_set():
+            raise ProcessTimeout("'%s' timed out after %ss" %
+                                 (' '.join(cmd), timeout))
+
+
+def run(cmd, timeout=None, group=None, **kwargs):
+    """Run a command until it exits or reaches its time limit.
+
+    The standard output and error are captured, unless kwargs redirect
+    them (e.g. stderr=subprocess.STDOUT).
+
+    :param cmd: the command to run
+    :type cmd: list
+    :param timeout: the time limit in seconds, or None
+    :type timeout: float
+    :param group: the group of the process, or None
+    :type group: ProcessGroup
+    :param kwargs: the other arguments of subprocess.Popen
+    :type kwargs: dict
+    :returns: the return code, the output and the error output
+    :rtype: tuple
+
+    """
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    kwargs.setdefault('stderr', subprocess.PIPE)
+    process = popen(cmd, **kwargs)
+    with supervise(process, cmd, timeout, group):
+        output, error = process.communicate()
+    return process.returncode, output, error
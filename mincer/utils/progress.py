@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Follow the progression of a stream."""
+
+import errno
+import logging
+import os
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Minimal delay between two progress reports, in seconds
+REPORT_INTERVAL = 5
+# Size of the chunks returned when the reader is iterated
+CHUNK_SIZE = 64 * 1024
+MB = 1024 * 1024
+
+
+class ProgressReader(object):
+
+    """A file object which counts the bytes read from it.
+
+    The progression, the throughput and the ETA are logged every
+    REPORT_INTERVAL seconds by the thread which reads the file, the final
+    throughput is logged once the end of the file is reached.
+    """
+
+    def __init__(self, fd, name, size=None, interval=REPORT_INTERVAL,
+                 cancelled=None):
+        """ProgressReader constructor
+
+        :param fd: the file object to read
+        :type fd: file
+        :param name: the name of the stream in the log
+        :type name: str
+        :param size: the size of the stream, the size of the file by
+         default
+        :type size: int
+        :param interval: the delay between two reports, in seconds
+        :type interval: float
+        :param cancelled: once set, the reads fail with ECANCELED
+        :type cancelled: threading.Event
+        :returns: None
+        :rtype: None
+
+        """
+        self._fd = fd
+        self.name = name
+        if size is None:
+            size = os.fstat(fd.fileno()).st_size
+        self.size = size
+        self._interval = interval
+        self._cancelled = cancelled
+        self.bytes_read = 0
+        self.started = None
+        self.finished = None
+        self._last_report = None
+
+    def read(self, size=-1):
+        """Read from the file and update the counters."""
+        if self._cancelled is not None and self._cancelled.is_set():
+            raise IOError(errno.ECANCELED, "%s: transfer cancelled" %
+                          self.name)
+        chunk = self._fd.read(size)
+        now = time.time()
+        if self.started is None:
+            self.started = self._last_report = now
+        self.bytes_read += len(chunk)
+        at_end = not chunk or self.bytes_read >= self.size
+        if self.finished is None and at_end:
+            self.finished = now
+            LOG.info("%s: %dM in %.1fs (%.1fM/s)" % (
+                self.name, self.bytes_read / MB, self.duration(),
+                self.rate() / MB))
+        elif now - self._last_report >= self._interval:
+            self._last_report = now
+            self.report()
+        return chunk
+
+    def __iter__(self):
+        """Iterate over the chunks of the file."""
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move in the file, the counters follow the position."""
+        self._fd.seek(offset, whence)
+        self.bytes_read = self._fd.tell()
+        if self.bytes_read == 0:
+            self.started = self.finished = None
+
+    def seekable(self):
+        """Return True, the image files can always seek."""
+        return True
+
+    def tell(self):
+        """Return the position in the file."""
+        return self._fd.tell()
+
+    def fileno(self):
+        """Return the file descriptor of the file."""
+        return self._fd.fileno()
+
+    def duration(self):
+        """Return the time spent reading, in seconds."""
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def rate(self):
+        """Return the throughput, in bytes per second."""
+        duration = self.duration()
+        if not duration:
+            return 0
+        return self.bytes_read / duration
+
+    def eta(self):
+        """Return the estimated time left, in seconds, or None."""
+        rate = self.rate()
+        if not rate:
+            return None
+        return max(self.size - self.bytes_read, 0) / rate
+
+    def report(self):
+        """Log the progression."""
+        eta = self.eta()
+        LOG.info("%s: %5dM /%5dM %6.1fM/s ETA %s" % (
+            self.name, self.bytes_read / MB, self.size / MB,
+            self.rate() / MB, '%ds' % eta if eta is not None else '?'))
+
+    def summary(self):
+        """Return the statistics of the transfer.
+
+        :returns: the size in bytes, the duration in seconds and the
+         throughput in bytes per second
+        :rtype: dict
+
+        """
+        return {'bytes': self.bytes_read,
+                'duration': round(self.duration(), 3),
+                'rate': int(self.rate())}
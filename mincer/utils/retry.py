@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Retry an operation with an exponential backoff."""
+
+import logging
+import random
+import socket
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class RetryPolicy(object):
+
+    """Describe how an operation has to be retried.
+
+    The delay between two attempts starts at initial_delay and is
+    multiplied by multiplier after each attempt, up to max_delay. A random
+    part of the delay, up to the jitter ratio, is removed to spread the
+    attempts. No new attempt is started once the deadline or max_attempts
+    is reached.
+
+    .. code-block:: python
+
+        for attempt in RetryPolicy(deadline=60).attempts():
+            try:
+                do_something()
+                break
+            except SomeError:
+                pass
+        else:
+            raise GiveUp()
+    """
+
+    def __init__(self, initial_delay=0.5, max_delay=10, multiplier=2,
+                 jitter=0.5, deadline=None, max_attempts=None):
+        """RetryPolicy constructor
+
+        :param initial_delay: the delay after the first attempt, in seconds
+        :type initial_delay: float
+        :param max_delay: the maximum delay between two attempts
+        :type max_delay: float
+        :param multiplier: the growth of the delay after each attempt
+        :type multiplier: float
+        :param jitter: the ratio of the delay which is randomized
+        :type jitter: float
+        :param deadline: the overall time limit, in seconds
+        :type deadline: float
+        :param max_attempts: the maximum number of attempts
+        :type max_attempts: int
+        :returns: None
+        :rtype: None
+
+        """
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+
+    def delay(self, attempt):
+        """Return the delay to wait after a given attempt.
+
+        :param attempt: the number of the attempt, starting from 0
+        :type attempt: int
+        :returns: the delay in seconds
+        :rtype: float
+
+        """
+        delay = min(self.max_delay,
+                    self.initial_delay * self.multiplier ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def attempts(self):
+        """Iterate over the attempts, waiting between them.
+
+        :returns: a generator of the attempt numbers, starting from 0
+        :rtype: generator
+
+        """
+        start = time.time()
+        attempt = 0
+        while True:
+            yield attempt
+            if self.max_attempts and attempt + 1 >= self.max_attempts:
+                return
+            delay = self.delay(attempt)
+            if self.deadline is not None and \
+                    time.time() + delay - start > self.deadline:
+                LOG.debug("Deadline of %ss reached" % self.deadline)
+                return
+            time.sleep(delay)
+            attempt += 1
+
+
+def port_is_open(host, port, timeout=1):
+    """Check a TCP port accepts the connections.
+
+    :param host: the host name or IP address
+    :type host: str
+    :param port: the TCP port
+    :type port: int
+    :param timeout: the connection timeout, in seconds
+    :type timeout: float
+    :returns: True if the connection succeeded
+    :rtype: bool
+
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
+
+
+def wait_for_port(host, port, policy):
+    """Wait until a TCP port accepts the connections.
+
+    :param host: the host name or IP address
+    :type host: str
+    :param port: the TCP port
+    :type port: int
+    :param policy: the policy to follow between two probes
+    :type policy: RetryPolicy
+    :returns: True if the port is open before the end of the policy
+    :rtype: bool
+
+    """
+    for attempt in policy.attempts():
+        if port_is_open(host, port):
+            return True
+        LOG.debug("%s:%s is not ready yet" % (host, port))
+    return False
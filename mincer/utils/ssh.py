@@ -17,24 +17,48 @@
 import logging
 import os
 import socket
-import time
+import threading
 
 import paramiko
 import six
 
+from mincer.utils import retry
+
 LOG = logging.getLogger(__name__)
 
 MAX_RETRY = 40
+# Overall time limit to establish a SSH connection, in seconds
+SSH_DEADLINE = 1200
+# Time limit of a readiness probe, in seconds
+PROBE_DEADLINE = 60
 
 
 class SSH(object):
 
     """paramiko abstraction class."""
 
-    def __init__(self, priv_key=None):
-        """SSH class constructor."""
+    def __init__(self, priv_key=None, retry_policy=None, probe_policy=None):
+        """SSH class constructor.
+
+        :param priv_key: the SSH private key
+        :type priv_key: str
+        :param retry_policy: how to retry the SSH handshakes
+        :type retry_policy: mincer.utils.retry.RetryPolicy
+        :param probe_policy: how to wait for a sshd to listen before the
+         handshake
+        :type probe_policy: mincer.utils.retry.RetryPolicy
+
+        """
+        self._retry_policy = retry_policy or retry.RetryPolicy(
+            initial_delay=1, max_delay=15, deadline=SSH_DEADLINE,
+            max_attempts=MAX_RETRY)
+        self._probe_policy = probe_policy or retry.RetryPolicy(
+            initial_delay=0.2, max_delay=1, deadline=PROBE_DEADLINE)
         self._ssh_client = None
         self._gateway_ip = None
+        self._transports = {}
+        self._host_locks = {}
+        self._pool_lock = threading.Lock()
         self._set_priv_key(priv_key)
 
     def _set_priv_key(self, priv_key):
@@ -56,13 +80,17 @@ class SSH(object):
         return ssh_config.lookup(hostname)
 
     def _try_start_ssh_client(self, client, cfg, user_config):
-        for retry in six.moves.range(0, MAX_RETRY):
+        for attempt in self._retry_policy.attempts():
+            LOG.info("Trying to open the SSH tunnel...")
+            if 'proxycommand' in user_config:
+                LOG.debug("proxycommand found in SSH user configuration")
+                cfg['sock'] = paramiko.ProxyCommand(
+                    user_config['proxycommand'])
+            elif 'hostname' in cfg and not retry.wait_for_port(
+                    cfg['hostname'], int(cfg.get('port', 22)),
+                    self._probe_policy):
+                continue
             try:
-                LOG.info("Trying to open the SSH tunnel...")
-                if 'proxycommand' in user_config:
-                    LOG.debug("proxycommand found in SSH user configuration")
-                    cfg['sock'] = paramiko.ProxyCommand(
-                        user_config['proxycommand'])
                 client.connect(**cfg)
                 self._ssh_client = client
                 break
@@ -70,9 +98,8 @@ class SSH(object):
                 LOG.debug(e)
             except paramiko.ssh_exception.SSHException as e:
                 LOG.debug(e)
-            time.sleep(5)
             LOG.info("retrying")
-        if (retry + 1) >= MAX_RETRY:
+        else:
             raise AuthOverSSHTransportError()
 
     def start_transport(self, gateway_ip):
@@ -101,36 +128,113 @@ class SSH(object):
         LOG.info("SSH transport is ready")
 
     def get_transport(self, host_ip=None):
-        """Open a session from the existing SSH transport.
+        """Return an authenticated SSH transport.
 
         The SSH transport has to be created first with start_transport()
 
+        Without host_ip, the transport of the gateway is returned. The
+        transport to a host is opened through the gateway on the first
+        call, then kept in a pool and reused as long as it is healthy.
+
         """
-        if host_ip is not None:
-            for retry in six.moves.range(0, MAX_RETRY):
-                try:
-                    LOG.info("Trying to open the SSH session...")
-                    channel = self._ssh_client.get_transport().open_channel(
-                        'direct-tcpip',
-                        (host_ip, 22),
-                        (self._gateway_ip, 0))
-
-                    t = paramiko.Transport(channel)
-                    t.start_client()
-
-                    t.auth_publickey('ec2-user', self._priv_key)
-                    break
-                except paramiko.ssh_exception.SSHException:
-                    time.sleep(30)
-                    LOG.info("Retrying")
-            if (retry + 1) >= MAX_RETRY:
-                raise AuthOverSSHTransportError()
-        else:
+        if host_ip is None:
             # Open a session directly on the Gateway
-            t = self._ssh_client.get_transport()
-
+            return self._ssh_client.get_transport()
+
+        with self._host_lock(host_ip):
+            t = self._transports.get(host_ip)
+            if t is not None:
+                if self._is_healthy(t):
+                    return t
+                LOG.info("SSH transport to %s is broken, "
+                         "reconnecting" % host_ip)
+                t.close()
+            t = self._connect(host_ip)
+            self._transports[host_ip] = t
         return t
 
+    def open_session(self, host_ip=None):
+        """Open a session on a host.
+
+        If the pooled transport of the host turns out to be dead, it is
+        replaced and the session is opened again once.
+
+        """
+        try:
+            return self.get_transport(host_ip).open_session()
+        except (paramiko.ssh_exception.SSHException, EOFError,
+                socket.error) as e:
+            if host_ip is None:
+                raise
+            LOG.debug(e)
+            self.drop_transport(host_ip)
+            return self.get_transport(host_ip).open_session()
+
+    def drop_transport(self, host_ip):
+        """Close the pooled transport of a host."""
+        with self._host_lock(host_ip):
+            t = self._transports.pop(host_ip, None)
+            if t is not None:
+                t.close()
+
+    def close(self):
+        """Close all the SSH transports."""
+        for host_ip in list(self._transports):
+            self.drop_transport(host_ip)
+        if self._ssh_client:
+            self._ssh_client.close()
+            self._ssh_client = None
+
+    def _host_lock(self, host_ip):
+        """Return the lock protecting the transport of a host."""
+        with self._pool_lock:
+            return self._host_locks.setdefault(host_ip, threading.Lock())
+
+    def _is_healthy(self, transport):
+        """Check a transport is still usable."""
+        if not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            transport.send_ignore()
+        except (paramiko.ssh_exception.SSHException, EOFError,
+                socket.error):
+            return False
+        return True
+
+    def _connect(self, host_ip):
+        """Open an authenticated transport to a host through the gateway."""
+        for attempt in self._retry_policy.attempts():
+            channel = self._open_channel(host_ip)
+            if channel is None:
+                continue
+            try:
+                LOG.info("Trying to open the SSH session...")
+                t = paramiko.Transport(channel)
+                t.start_client()
+
+                t.auth_publickey('ec2-user', self._priv_key)
+                return t
+            except paramiko.ssh_exception.SSHException as e:
+                LOG.debug(e)
+                LOG.info("Retrying")
+        raise AuthOverSSHTransportError()
+
+    def _open_channel(self, host_ip):
+        """Open a channel to the sshd of a host through the gateway.
+
+        The gateway refuses the channel until the sshd listens, this is a
+        cheap readiness probe which is retried following the probe policy.
+
+        """
+        for attempt in self._probe_policy.attempts():
+            try:
+                return self._ssh_client.get_transport().open_channel(
+                    'direct-tcpip',
+                    (host_ip, 22),
+                    (self._gateway_ip, 0))
+            except paramiko.ChannelException as e:
+                LOG.debug("%s: %s" % (host_ip, e))
+
 
 class AuthOverSSHTransportError(Exception):
 
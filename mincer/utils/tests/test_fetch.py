@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+import fixtures
+import mock
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+import testtools
+
+from mincer.utils import fetch
+from mincer.utils import retry
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._answer(body=False)
+
+    def do_GET(self):
+        self._answer(body=True)
+
+    def _answer(self, body):
+        server = self.server
+        server.requests.append((self.command, self.headers.get('Range')))
+        content = server.content
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if match and server.ranges and \
+                self.headers.get('If-Range') in (None, server.etag):
+            start, end = int(match.group(1)), int(match.group(2))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end, len(content)))
+            content = content[start:end + 1]
+        else:
+            self.send_response(200)
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+
+class TestFetcher(testtools.TestCase):
+
+    def setUp(self):
+        super(TestFetcher, self).setUp()
+        self.useFixture(fixtures.EnvironmentVariable(
+            'MINCER_CACHE_DIR', tempfile.mkdtemp()))
+        self.useFixture(fixtures.MonkeyPatch(
+            'mincer.utils.fetch.RANGE_SIZE', 1000))
+        self.useFixture(fixtures.MonkeyPatch(
+            'mincer.utils.fetch.MIN_RANGE_SIZE', 2000))
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.content = os.urandom(4500)
+        self.server.etag = '"v1"'
+        self.server.ranges = True
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/image.qcow2' % (
+            self.server.server_address[1])
+
+    def _fetcher(self):
+        return fetch.Fetcher(self.url, retry_policy=retry.RetryPolicy(
+            initial_delay=0, max_attempts=2))
+
+    def _content(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_fetch_ranges(self):
+        path = self._fetcher().fetch()
+        self.assertEqual('image.qcow2', os.path.basename(path))
+        self.assertEqual(self.server.content, self._content(path))
+        ranges = sorted(r for c, r in self.server.requests if c == 'GET')
+        self.assertEqual(['bytes=0-999', 'bytes=1000-1999',
+                          'bytes=2000-2999', 'bytes=3000-3999',
+                          'bytes=4000-4499'], ranges)
+
+    def test_fetch_without_ranges(self):
+        self.server.ranges = False
+        path = self._fetcher().fetch()
+        self.assertEqual(self.server.content, self._content(path))
+        self.assertEqual([('HEAD', None), ('GET', None)],
+                         self.server.requests)
+
+    def test_reuse_fresh_copy(self):
+        path = self._fetcher().fetch()
+        self.server.requests = []
+        self.assertEqual(path, self._fetcher().fetch())
+        self.assertEqual([('HEAD', None)], self.server.requests)
+
+        self.server.content = os.urandom(4500)
+        self.server.etag = '"v2"'
+        self._fetcher().fetch()
+        self.assertEqual(self.server.content, self._content(path))
+
+    def test_reuse_with_checksum(self):
+        checksum = hashlib.md5(self.server.content).hexdigest()
+        path = self._fetcher().fetch(checksum)
+        self.server.requests = []
+        self.server.server_close()
+        self.assertEqual(path, self._fetcher().fetch(checksum))
+        self.assertEqual([], self.server.requests)
+
+    def test_checksum_mismatch(self):
+        fetcher = self._fetcher()
+        self.assertRaises(fetch.FetchError, fetcher.fetch, 'bad')
+        self.assertFalse(os.path.exists(fetcher.path))
+        self.assertFalse(os.path.exists(fetcher.path + '.part'))
+
+    def test_file_changed_during_download(self):
+        fetcher = self._fetcher()
+        with mock.patch.object(fetcher, '_head', return_value={
+                'size': 4500, 'etag': '"v0"', 'last_modified': None,
+                'ranges': True}):
+            self.assertRaises(fetch.FetchError, fetcher.fetch)
+        self.assertFalse(os.path.exists(fetcher.path + '.part'))
+
+    def test_unreachable_reuses_copy(self):
+        path = self._fetcher().fetch()
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(path, self._fetcher().fetch())
+        self.assertRaises(fetch.FetchError, self._fetcher().fetch, 'other')
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import os
+import tempfile
+
+import fixtures
+import mock
+import testtools
+
+from mincer.utils import cache
+from mincer.utils import fingerprint
+
+
+class TestFingerprint(testtools.TestCase):
+
+    def setUp(self):
+        super(TestFingerprint, self).setUp()
+        self.useFixture(fixtures.NestedTempfile())
+        self.cache_dir = tempfile.mkdtemp()
+        self.useFixture(fixtures.EnvironmentVariable(
+            'MINCER_CACHE_DIR', self.cache_dir))
+        self.content = b'a' * (fingerprint.READ_BUFFER_SIZE + 10)
+        self.image = tempfile.NamedTemporaryFile(delete=False).name
+        with open(self.image, 'wb') as f:
+            f.write(self.content)
+
+    def test_md5sum(self):
+        self.assertEqual(hashlib.md5(self.content).hexdigest(),
+                         fingerprint.md5sum(self.image))
+
+    def test_cache_dir(self):
+        self.assertEqual(os.path.join(self.cache_dir, 'a', 'b'),
+                         cache.cache_dir('a', 'b'))
+        self.assertTrue(os.path.isdir(cache.cache_dir('a', 'b')))
+
+    def test_checksum_is_cached(self):
+        reference = fingerprint.md5sum(self.image)
+        with mock.patch.object(fingerprint, 'md5sum',
+                               wraps=fingerprint.md5sum) as md5sum:
+            self.assertEqual(reference, fingerprint.checksum(self.image))
+            # a new cache instance reads the same database
+            self.assertEqual(reference, fingerprint.checksum(self.image))
+            self.assertEqual(1, md5sum.call_count)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache_dir, 'fingerprints.sqlite')))
+
+    def test_checksum_without_cache(self):
+        self.useFixture(fixtures.EnvironmentVariable(
+            'MINCER_CACHE_DIR', '/dev/null/mincer'))
+        self.assertEqual(fingerprint.md5sum(self.image),
+                         fingerprint.checksum(self.image))
+
+    def test_checksum_with_a_broken_database(self):
+        with open(os.path.join(self.cache_dir, 'fingerprints.sqlite'),
+                  'w') as f:
+            f.write('not a database' * 100)
+        self.assertEqual(fingerprint.md5sum(self.image),
+                         fingerprint.checksum(self.image))
+
+    def test_checksum_of_modified_file(self):
+        fingerprint.checksum(self.image)
+        with open(self.image, 'ab') as f:
+            f.write(b'b')
+        self.assertEqual(fingerprint.md5sum(self.image),
+                         fingerprint.checksum(self.image))
+
+    def test_tree_digest(self):
+        tree = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tree, 'a', 'b'))
+        with open(os.path.join(tree, 'a', 'b', 'file'), 'w') as f:
+            f.write('foo')
+        os.symlink('b/file', os.path.join(tree, 'a', 'link'))
+        reference = fingerprint.tree_digest(tree)
+        self.assertEqual(reference, fingerprint.tree_digest(tree))
+
+        with open(os.path.join(tree, 'a', 'b', 'file'), 'w') as f:
+            f.write('bar')
+        modified = fingerprint.tree_digest(tree)
+        self.assertNotEqual(reference, modified)
+
+        os.mkdir(os.path.join(tree, 'c'))
+        self.assertNotEqual(modified, fingerprint.tree_digest(tree))
+
+    def test_tree_digest_does_not_open_the_pipes(self):
+        tree = tempfile.mkdtemp()
+        os.mkfifo(os.path.join(tree, 'fifo'))
+        with mock.patch.object(fingerprint, 'md5sum') as md5sum:
+            reference = fingerprint.tree_digest(tree)
+        self.assertFalse(md5sum.called)
+        os.chmod(os.path.join(tree, 'fifo'), 0o600)
+        self.assertNotEqual(reference, fingerprint.tree_digest(tree))
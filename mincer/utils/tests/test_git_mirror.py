@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import subprocess
+import tempfile
+
+import fixtures
+import mock
+import testtools
+
+from mincer.utils import git_mirror
+from mincer.utils import processes
+
+
+def _git(repo, *args):
+    return subprocess.check_output(
+        ['git', '-C', repo, '-c', 'user.name=mincer',
+         '-c', 'user.email=mincer@example.com'] + list(args))
+
+
+def _commit(repo, name, content):
+    with open(os.path.join(repo, name), 'w') as f:
+        f.write(content)
+    _git(repo, 'add', name)
+    _git(repo, 'commit', '-q', '-m', name)
+    return _git(repo, 'rev-parse', 'HEAD').decode('utf-8').strip()
+
+
+class TestGitMirror(testtools.TestCase):
+
+    def setUp(self):
+        super(TestGitMirror, self).setUp()
+        self.useFixture(fixtures.NestedTempfile())
+        self.useFixture(fixtures.EnvironmentVariable(
+            'MINCER_CACHE_DIR', tempfile.mkdtemp()))
+        self.useFixture(fixtures.MonkeyPatch(
+            'mincer.utils.git_mirror.GitMirror._fetched', set()))
+        self.repo = tempfile.mkdtemp()
+        _git(self.repo, 'init', '-q', '-b', 'master')
+        self.first = _commit(self.repo, 'README', 'first')
+        _git(self.repo, 'tag', 'v1')
+
+    def test_export(self):
+        mirror = git_mirror.GitMirror(self.repo)
+        commit = mirror.resolve('v1')
+        self.assertEqual(self.first, commit)
+        target_dir = tempfile.mkdtemp()
+        mirror.export(commit, target_dir)
+        self.assertEqual(['README'], os.listdir(target_dir))
+
+    def test_export_is_supervised(self):
+        mirror = git_mirror.GitMirror(self.repo)
+        commit = mirror.resolve('v1')
+        group = processes.ProcessGroup()
+        with mock.patch.object(processes, 'supervise',
+                               wraps=processes.supervise) as supervise:
+            mirror.export(commit, tempfile.mkdtemp(), 60, group)
+        supervise.assert_called_once_with(mock.ANY, mock.ANY, 60, group)
+
+    def test_fetch_once_per_process(self):
+        git_mirror.GitMirror(self.repo).update()
+        second = _commit(self.repo, 'NEWS', 'second')
+
+        mirror = git_mirror.GitMirror(self.repo)
+        with mock.patch.object(mirror, '_git') as git:
+            mirror.update()
+        self.assertFalse(git.called)
+
+        git_mirror.GitMirror._fetched.clear()
+        self.assertEqual(second, mirror.resolve('master'))
+        self.assertEqual(self.first, mirror.resolve('v1'))
+
+    def test_unknown_ref(self):
+        mirror = git_mirror.GitMirror(self.repo)
+        self.assertRaises(git_mirror.GitMirrorError, mirror.resolve, 'nope')
+
+    def test_clone_failure(self):
+        mirror = git_mirror.GitMirror(self.repo + '/missing')
+        self.assertRaises(git_mirror.GitMirrorError, mirror.update)
+        self.assertFalse(os.path.exists(mirror.path))
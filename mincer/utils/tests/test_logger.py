@@ -15,6 +15,7 @@
 # under the License.
 
 import logging
+import threading
 
 import mock
 import testtools
@@ -27,6 +28,9 @@ class TestLogger(testtools.TestCase):
     def setUp(self):
         super(TestLogger, self).setUp()
         self.logger = logging.getLogger()
+        self.addCleanup(self.logger.setLevel, self.logger.level)
+        self.addCleanup(setattr, self.logger, 'handlers',
+                        list(self.logger.handlers))
         self.logger.setLevel(logging.DEBUG)
         self.auth_args = {
             'user': 'admin',
@@ -72,3 +76,12 @@ class TestLogger(testtools.TestCase):
         swift_cnx.put_object.assert_has_calls([
             mock.call('log', 'name-00', 'Bibi'),
             mock.call('log', 'name-01', 'Bibi')])
+
+    @mock.patch('swiftclient.client.Connection')
+    def test_flush_empty_buffer_releases_the_lock(self, swift):
+        logHandler = mincer.utils.logger.RotatingSwiftHandler(self.auth_args)
+        logHandler.flush()
+        thread = threading.Thread(target=logHandler.flush)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
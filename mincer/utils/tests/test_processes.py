@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import subprocess
+import threading
+import time
+
+import testtools
+
+from mincer.utils import processes
+
+
+class TestProcesses(testtools.TestCase):
+
+    def test_run(self):
+        returncode, output, error = processes.run(
+            ['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual((3, b'out\n', b'err\n'), (returncode, output, error))
+
+    def test_run_merged_output(self):
+        returncode, output, error = processes.run(
+            ['sh', '-c', 'echo out; echo err >&2'], stderr=subprocess.STDOUT)
+        self.assertEqual((0, b'out\nerr\n', None),
+                         (returncode, output, error))
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(processes.ProcessTimeout, processes.run,
+                          ['sleep', '30'], timeout=0.2)
+        self.assertLess(time.time() - start, 10)
+
+    def test_timeout_kills_the_children(self):
+        # the children of the shell keep the output pipe open
+        start = time.time()
+        self.assertRaises(processes.ProcessTimeout, processes.run,
+                          ['sh', '-c', 'sleep 30; echo done'], timeout=0.2)
+        self.assertLess(time.time() - start, 10)
+
+    def test_group_kill(self):
+        group = processes.ProcessGroup()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            processes.run(['sh', '-c', 'sleep 30; echo done'],
+                          group=group)))
+        thread.start()
+        while not group._processes:
+            time.sleep(0.01)
+        group.kill()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertNotEqual(0, results[0][0])
+        self.assertEqual(set(), group._processes)
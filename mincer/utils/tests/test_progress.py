@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import io
+import tempfile
+import threading
+
+from glanceclient.common import utils as glance_utils
+import mock
+import testtools
+
+from mincer.utils import progress
+
+MB = 1024 * 1024
+
+
+class TestProgressReader(testtools.TestCase):
+
+    def setUp(self):
+        super(TestProgressReader, self).setUp()
+        self.fd = io.BytesIO(b'a' * 4 * MB)
+
+    @mock.patch.object(progress, 'LOG')
+    @mock.patch.object(progress, 'time')
+    def test_read(self, mock_time, mock_log):
+        reader = progress.ProgressReader(self.fd, 'foo', size=4 * MB)
+        for now in (100, 101):
+            mock_time.time.return_value = now
+            self.assertEqual(MB, len(reader.read(MB)))
+        self.assertFalse(mock_log.info.called)
+        mock_time.time.return_value = 106
+        reader.read(MB)
+        mock_log.info.assert_called_with(
+            'foo:     3M /    4M    0.5M/s ETA 2s')
+        mock_time.time.return_value = 108
+        reader.read(MB)
+        mock_log.info.assert_called_with('foo: 4M in 8.0s (0.5M/s)')
+        self.assertEqual(b'', reader.read(MB))
+        self.assertEqual(2, mock_log.info.call_count)
+        self.assertEqual({'bytes': 4 * MB, 'duration': 8,
+                          'rate': MB // 2}, reader.summary())
+
+    def test_read_cancelled(self):
+        cancelled = threading.Event()
+        reader = progress.ProgressReader(self.fd, 'foo', size=4 * MB,
+                                         cancelled=cancelled)
+        self.assertEqual(MB, len(reader.read(MB)))
+        cancelled.set()
+        error = self.assertRaises(IOError, reader.read, MB)
+        self.assertEqual(errno.ECANCELED, error.errno)
+
+    def test_iter_and_seek(self):
+        reader = progress.ProgressReader(self.fd, 'foo', size=4 * MB)
+        self.assertEqual(4 * MB, sum(len(chunk) for chunk in reader))
+        self.assertEqual(4 * MB, reader.bytes_read)
+        reader.seek(0)
+        self.assertEqual(0, reader.bytes_read)
+        self.assertIsNone(reader.started)
+        reader.seek(0, 2)
+        self.assertEqual(4 * MB, reader.tell())
+
+    def test_glanceclient_file_size(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'a' * 100)
+            f.seek(0)
+            reader = progress.ProgressReader(f, 'foo', size=100)
+            self.assertEqual(f.fileno(), reader.fileno())
+            self.assertEqual(100, glance_utils.get_file_size(reader))
+            self.assertEqual(0, reader.tell())
+            self.assertEqual(0, reader.bytes_read)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import socket
+
+import mock
+import testtools
+
+from mincer.utils import retry
+
+
+class TestRetryPolicy(testtools.TestCase):
+
+    def test_delay(self):
+        policy = retry.RetryPolicy(initial_delay=1, max_delay=5,
+                                   multiplier=2, jitter=0)
+        self.assertEqual([1, 2, 4, 5, 5],
+                         [policy.delay(i) for i in range(5)])
+
+    def test_delay_with_jitter(self):
+        policy = retry.RetryPolicy(initial_delay=4, jitter=0.5)
+        for _ in range(100):
+            self.assertTrue(2 <= policy.delay(0) <= 4)
+
+    @mock.patch('time.sleep')
+    def test_attempts_max_attempts(self, sleep):
+        policy = retry.RetryPolicy(initial_delay=1, jitter=0,
+                                   max_attempts=3)
+        self.assertEqual([0, 1, 2], list(policy.attempts()))
+        self.assertEqual([mock.call(1), mock.call(2)],
+                         sleep.call_args_list)
+
+    @mock.patch.object(retry, 'time')
+    def test_attempts_deadline(self, time):
+        time.time.side_effect = [0, 0, 5, 9]
+        policy = retry.RetryPolicy(initial_delay=2, multiplier=1,
+                                   jitter=0, deadline=10)
+        self.assertEqual([0, 1, 2], list(policy.attempts()))
+
+
+class TestPortProbe(testtools.TestCase):
+
+    def test_port_is_open(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        self.assertTrue(retry.port_is_open('127.0.0.1', port))
+        server.close()
+        self.assertFalse(retry.port_is_open('127.0.0.1', port))
+
+    @mock.patch('time.sleep', mock.Mock())
+    def test_wait_for_port(self):
+        policy = retry.RetryPolicy(max_attempts=3)
+        with mock.patch.object(retry, 'port_is_open',
+                               mock.Mock(side_effect=[False, True])):
+            self.assertTrue(retry.wait_for_port('host', 22, policy))
+        with mock.patch.object(retry, 'port_is_open',
+                               mock.Mock(return_value=False)):
+            self.assertFalse(retry.wait_for_port('host', 22, policy))
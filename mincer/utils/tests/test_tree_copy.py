@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import os
+import socket
+import stat
+import tempfile
+
+import fixtures
+import mock
+import testtools
+
+from mincer.utils import tree_copy
+
+
+class TestTreeCopy(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTreeCopy, self).setUp()
+        self.useFixture(fixtures.NestedTempfile())
+        self.src_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.src_dir, 'foo', 'bar'))
+        for name in ('.hidden', 'foo/file', 'foo/bar/file'):
+            with open(os.path.join(self.src_dir, name), 'w') as f:
+                f.write(name * 1000)
+        os.symlink('foo', os.path.join(self.src_dir, 'link'))
+        self.dst_dir = os.path.join(tempfile.mkdtemp(), 'dst')
+
+    def _assert_copied(self):
+        for name in ('.hidden', 'foo/file', 'foo/bar/file'):
+            with open(os.path.join(self.dst_dir, name)) as f:
+                self.assertEqual(name * 1000, f.read())
+        self.assertEqual('foo',
+                         os.readlink(os.path.join(self.dst_dir, 'link')))
+
+    def test_copy_tree(self):
+        stats = tree_copy.copy_tree(self.src_dir, self.dst_dir)
+        self._assert_copied()
+        self.assertEqual(3, sum(stats.values()))
+
+    def test_special_files(self):
+        os.mkfifo(os.path.join(self.src_dir, 'foo', 'fifo'), 0o640)
+        sock = socket.socket(socket.AF_UNIX)
+        self.addCleanup(sock.close)
+        sock.bind(os.path.join(self.src_dir, 'sock'))
+        stats = tree_copy.copy_tree(self.src_dir, self.dst_dir)
+        self._assert_copied()
+        fifo = os.lstat(os.path.join(self.dst_dir, 'foo', 'fifo')).st_mode
+        self.assertTrue(stat.S_ISFIFO(fifo))
+        self.assertEqual(0o640, stat.S_IMODE(fifo))
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir, 'sock')))
+        self.assertEqual(1, stats['fifo'])
+        self.assertEqual(1, stats['skipped'])
+
+    def test_copy_without_reflink_nor_hardlink(self):
+        unsupported = IOError(errno.EOPNOTSUPP, 'Operation not supported')
+        copier = tree_copy.TreeCopy(hardlink=False, workers=1)
+        with mock.patch.object(tree_copy.fcntl, 'ioctl',
+                               side_effect=unsupported) as ioctl:
+            stats = copier.copy_tree(self.src_dir, self.dst_dir)
+        self._assert_copied()
+        self.assertEqual({'copy': 3}, stats)
+        self.assertEqual(1, ioctl.call_count)
+        self.assertNotEqual(
+            os.stat(os.path.join(self.src_dir, 'foo/file')).st_ino,
+            os.stat(os.path.join(self.dst_dir, 'foo/file')).st_ino)
+
+    def test_hardlink_fallback(self):
+        unsupported = IOError(errno.EOPNOTSUPP, 'Operation not supported')
+        with mock.patch.object(tree_copy.fcntl, 'ioctl',
+                               side_effect=unsupported):
+            stats = tree_copy.copy_tree(self.src_dir, self.dst_dir)
+        self._assert_copied()
+        self.assertEqual({'hardlink': 3}, stats)
+        self.assertEqual(
+            os.stat(os.path.join(self.src_dir, 'foo/file')).st_ino,
+            os.stat(os.path.join(self.dst_dir, 'foo/file')).st_ino)
+
+    def test_copy_error(self):
+        with mock.patch.object(tree_copy, 'reflink',
+                               side_effect=IOError(errno.EXDEV, 'EXDEV')), \
+                mock.patch.object(tree_copy, 'copy',
+                                  side_effect=IOError(errno.EIO, 'EIO')):
+            copier = tree_copy.TreeCopy(hardlink=False)
+            self.assertRaises(IOError, copier.copy_tree, self.src_dir,
+                              self.dst_dir)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Copy a directory tree as cheaply as the filesystems allow."""
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+import threading
+
+from concurrent import futures
+
+LOG = logging.getLogger(__name__)
+
+# Number of files copied concurrently
+COPY_WORKERS = 8
+# Size of the buffer of the regular copies
+COPY_BUFFER_SIZE = 1024 * 1024
+# ioctl cloning a file on a copy-on-write filesystem (btrfs, xfs...)
+FICLONE = 0x40049409
+
+# The errors meaning a method is not available for a pair of files
+_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY,
+                errno.EPERM, errno.EACCES, errno.EMLINK)
+
+
+def reflink(src, dst):
+    """Clone a file, the copy shares the blocks of the original."""
+    with open(src, 'rb') as src_fd:
+        with open(dst, 'wb') as dst_fd:
+            try:
+                fcntl.ioctl(dst_fd.fileno(), FICLONE, src_fd.fileno())
+            except (IOError, OSError):
+                dst_fd.close()
+                os.unlink(dst)
+                raise
+    shutil.copymode(src, dst)
+
+
+def copy(src, dst):
+    """Copy the content of a file with a large buffer."""
+    with open(src, 'rb') as src_fd:
+        with open(dst, 'wb') as dst_fd:
+            shutil.copyfileobj(src_fd, dst_fd, COPY_BUFFER_SIZE)
+    shutil.copymode(src, dst)
+
+
+class TreeCopy(object):
+
+    """Copy the content of a directory into another one.
+
+    The files are cloned (reflink) when the filesystem supports it,
+    hardlinked when both trees are on the same filesystem, and copied
+    otherwise. A method which fails once is not tried again for the next
+    files. The hidden files and the symbolic links are copied too, the
+    named pipes are recreated and the sockets and devices are skipped:
+    opening them could block forever.
+    """
+
+    def __init__(self, hardlink=True, workers=COPY_WORKERS):
+        """TreeCopy constructor
+
+        :param hardlink: allow the hardlinks, the copy then shares the
+         content of the original files, which must not be modified
+        :type hardlink: bool
+        :param workers: the number of files copied concurrently
+        :type workers: int
+        :returns: None
+        :rtype: None
+
+        """
+        self._methods = [('reflink', reflink)]
+        if hardlink:
+            self._methods.append(('hardlink', os.link))
+        self._workers = workers
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def copy_tree(self, src_dir, dst_dir):
+        """Copy the content of src_dir in dst_dir.
+
+        :param src_dir: the source directory
+        :type src_dir: str
+        :param dst_dir: the destination directory, created if needed
+        :type dst_dir: str
+        :returns: the number of files copied with each method
+        :rtype: dict
+
+        """
+        files = []
+        for root, dirs, names in os.walk(src_dir):
+            dst_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+            if not os.path.isdir(dst_root):
+                os.makedirs(dst_root)
+            shutil.copymode(root, dst_root)
+            for name in dirs + names:
+                src = os.path.join(root, name)
+                dst = os.path.join(dst_root, name)
+                mode = os.lstat(src).st_mode
+                if stat.S_ISLNK(mode):
+                    os.symlink(os.readlink(src), dst)
+                    if name in dirs:
+                        dirs.remove(name)
+                elif stat.S_ISREG(mode):
+                    files.append((src, dst))
+                elif stat.S_ISFIFO(mode):
+                    os.mkfifo(dst, stat.S_IMODE(mode))
+                    self._count('fifo')
+                elif not stat.S_ISDIR(mode):
+                    LOG.warning("%s is not a regular file, skipped" % src)
+                    self._count('skipped')
+
+        with futures.ThreadPoolExecutor(max_workers=self._workers) as pool:
+            for job in [pool.submit(self._copy_file, src, dst)
+                        for src, dst in files]:
+                job.result()
+        LOG.debug("%s copied to %s: %s" % (src_dir, dst_dir, self.stats))
+        return self.stats
+
+    def _copy_file(self, src, dst):
+        """Copy a file with the cheapest method available."""
+        for name, method in list(self._methods):
+            try:
+                method(src, dst)
+            except (IOError, OSError) as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                LOG.debug("%s is not available for %s: %s" % (name, dst, e))
+                with self._lock:
+                    if (name, method) in self._methods:
+                        self._methods.remove((name, method))
+                continue
+            break
+        else:
+            name = 'copy'
+            copy(src, dst)
+        self._count(name)
+
+    def _count(self, name):
+        """Count an entry handled with a given method."""
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+
+def copy_tree(src_dir, dst_dir, hardlink=True):
+    """Copy the content of a directory into another one.
+
+    :param src_dir: the source directory
+    :type src_dir: str
+    :param dst_dir: the destination directory, created if needed
+    :type dst_dir: str
+    :param hardlink: allow the hardlinks
+    :type hardlink: bool
+    :returns: the number of files copied with each method
+    :rtype: dict
+
+    """
+    return TreeCopy(hardlink=hardlink).copy_tree(src_dir, dst_dir)
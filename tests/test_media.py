@@ -14,11 +14,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
 import os
+import subprocess
+import tarfile
 import tempfile
 import unittest
 
 import fixtures
+import mock
 import testtools
 
 try:
@@ -27,6 +31,7 @@ except ImportError:
     guestfs = None
 
 from mincer import media as mediaObj
+from mincer.utils import fingerprint
 
 SAMPLE_MEDIAS = {
     'description': 'Roberto',
@@ -51,6 +56,8 @@ class TestMedia(testtools.TestCase):
         super(TestMedia, self).setUp()
 
         self.useFixture(fixtures.NestedTempfile())
+        self.useFixture(fixtures.EnvironmentVariable(
+            'MINCER_CACHE_DIR', tempfile.mkdtemp()))
         self.media = mediaObj.Media("Merguez Partie",
                                     {'description': "Yo!",
                                      'type': 'dynamic',
@@ -69,10 +76,384 @@ class TestMedia(testtools.TestCase):
         media._produce_image()
         self.assertRegexpMatches(media.checksum, '\w{32}')
 
+    def test_local_checksum_is_lazy(self):
+        image = tempfile.NamedTemporaryFile()
+        image.write(b'Merguez' * 1000000)
+        image.flush()
+        with mock.patch.object(fingerprint, 'md5sum',
+                               wraps=fingerprint.md5sum) as md5sum:
+            media = mediaObj.Media("Alphonse", {'type': 'local',
+                                                'path': image.name,
+                                                'filter_on': ['checksum']})
+            self.assertFalse(md5sum.called)
+            self.assertEqual(
+                hashlib.md5(b'Merguez' * 1000000).hexdigest(),
+                media.checksum)
+            self.assertEqual(media.checksum, media.checksum)
+            md5sum.assert_called_once_with(image.name)
+
+    def test_checksum_from_description(self):
+        media = mediaObj.Media("Alphonse", {'type': 'local',
+                                            'path': '/nowhere',
+                                            'checksum': 'abc'})
+        self.assertEqual('abc', media.checksum)
+
+    def test_digest(self):
+        script = {'driver': 'script', 'value': '#!/bin/sh\n', 'target': 'a'}
+        local = {'driver': 'local', 'path': self.tdir_with_data,
+                 'target': 'b'}
+        media = mediaObj.Media("Alphonse", {'type': 'dynamic',
+                                            'sources': [script, local]})
+        same = mediaObj.Media("Gaston", {'type': 'dynamic',
+                                         'sources': [script, local]})
+        self.assertEqual(media.digest, same.digest)
+
+        _add_some_files(self.tdir_empty)
+        with open(self.tdir_empty + '/foo/file', 'w') as f:
+            f.write("barfoo")
+        other = mediaObj.Media("Gaston", {'type': 'dynamic',
+                                          'sources': [
+                                              script,
+                                              dict(local,
+                                                   path=self.tdir_empty)]})
+        self.assertNotEqual(media.digest, other.digest)
+        self.assertEqual({'mincer_digest': media.digest},
+                         media.glance_properties())
+
+    def test_git_source(self):
+        repo = tempfile.mkdtemp()
+        _add_some_files(repo)
+        git = ['git', '-C', repo, '-c', 'user.name=mincer',
+               '-c', 'user.email=mincer@example.com']
+        # no master branch, the default branch is used
+        subprocess.check_call(git + ['init', '-q', '-b', 'main'])
+        subprocess.check_call(git + ['add', '.'])
+        subprocess.check_call(git + ['commit', '-q', '-m', 'first'])
+        source = {'driver': 'git', 'value': repo, 'target': 'repo'}
+        media = mediaObj.Media("Alphonse", {'type': 'dynamic',
+                                            'sources': [source]})
+        digest = media.digest
+
+        # the content matches the digest even if the branch moves
+        subprocess.check_call(git + ['rm', '-q', '-r', 'foo'])
+        subprocess.check_call(git + ['commit', '-q', '-m', 'second'])
+        media._collect_data()
+        self.assertEqual(['foo'], os.listdir(media.data_dir + '/repo'))
+        self.assertEqual(digest, media.digest)
+
+        missing = mediaObj.Media("Alphonse", {
+            'type': 'dynamic', 'sources': [dict(source, ref='nope')]})
+        self.assertRaises(mediaObj.MediaManagerException,
+                          getattr, missing, 'digest')
+
+    def test_generate_reuses_the_cache(self):
+        media = mediaObj.Media("Alphonse", SAMPLE_MEDIAS)
+
+        def produce_images(medias):
+            with open(media._dynamic_image, 'w') as f:
+                f.write('image')
+
+        with mock.patch.object(media, '_collect_data'), \
+                mock.patch.object(mediaObj, '_produce_images',
+                                  side_effect=produce_images) as produce:
+            media.generate()
+            self.assertTrue(media.getPath().startswith(
+                os.environ['MINCER_CACHE_DIR']))
+
+            again = mediaObj.Media("Alphonse", SAMPLE_MEDIAS)
+            again._collect_data = mock.Mock()
+            again.generate()
+            self.assertFalse(again._collect_data.called)
+        self.assertEqual(1, produce.call_count)
+        self.assertEqual(media.getPath(), again.getPath())
+
+    def test_store_failure_leaves_no_partial_image(self):
+        media = mediaObj.Media("Alphonse", SAMPLE_MEDIAS)
+        with open(media._dynamic_image, 'w') as f:
+            f.write('image')
+
+        def move(src, dst):
+            with open(dst, 'w') as f:
+                f.write('ima')
+            raise IOError('No space left on device')
+
+        with mock.patch('shutil.move', side_effect=move):
+            self.assertRaises(IOError, media._store)
+        cache_dir = os.path.dirname(media._cached_image())
+        self.assertEqual([], os.listdir(cache_dir))
+        media._generated = False
+        self.assertTrue(media.needs_build())
+
+    def test_generate_without_cache(self):
+        media = mediaObj.Media("Alphonse", dict(SAMPLE_MEDIAS, cache=False))
+        with mock.patch.object(media, '_collect_data'), \
+                mock.patch.object(mediaObj, '_produce_images') as produce:
+            media.generate()
+            media.generate()
+        produce.assert_called_once_with([media])
+        self.assertEqual(media._dynamic_image, media.getPath())
+
+    def test_generate_medias_shares_the_appliances(self):
+        medias = [mediaObj.Media("Alphonse%d" % i,
+                                 dict(SAMPLE_MEDIAS, cache=False))
+                  for i in range(5)]
+        local = mediaObj.Media("Gaston", {'type': 'local', 'path': '/a'})
+        fake_guestfs = mock.Mock()
+        appliances = []
+
+        def new_appliance():
+            g = mock.Mock()
+            g.list_devices.side_effect = lambda: [
+                '/dev/sd%s' % chr(ord('a') + i)
+                for i in range(g.add_drive_opts.call_count)]
+            g.list_partitions.side_effect = lambda: [
+                d + '1' for d in g.list_devices()]
+            g.part_to_dev.side_effect = lambda p: p[:-1]
+            appliances.append(g)
+            return g
+
+        fake_guestfs.GuestFS.side_effect = new_appliance
+        with mock.patch.dict('sys.modules', guestfs=fake_guestfs), \
+                mock.patch.object(mediaObj.Media, '_tar_in'):
+            mediaObj.generate_medias(medias + [local],
+                                     drives_per_appliance=2)
+        self.assertEqual(3, len(appliances))
+        for g in appliances:
+            g.launch.assert_called_once_with()
+            g.close.assert_called_once_with()
+        self.assertEqual(
+            [['/dev/sda1'], ['/dev/sda1', '/dev/sdb1'],
+             ['/dev/sda1', '/dev/sdb1']],
+            sorted([c[0][1] for c in g.mkfs.call_args_list]
+                   for g in appliances))
+        self.assertFalse(any(m.needs_build() for m in medias))
+
+    def test_collect_data(self):
+        media = mediaObj.Media("Alphonse", {
+            'type': 'dynamic',
+            'sources': [
+                {'driver': 'script', 'target': 'a',
+                 'value': '#!/bin/sh\necho $BASE_DIR > base_dir\n'},
+                {'driver': 'local', 'target': 'b',
+                 'path': self.tdir_with_data}]})
+        media._collect_data()
+        with open(media.data_dir + '/a/base_dir') as f:
+            self.assertEqual(os.getcwd(), f.read().strip())
+        self.assertTrue(os.path.exists(media.data_dir + '/b/foo/bar/file'))
+
+    def test_collect_data_failure(self):
+        media = mediaObj.Media("Alphonse", {
+            'type': 'dynamic',
+            'sources': [
+                {'driver': 'script', 'target': 'a',
+                 'value': '#!/bin/sh\necho oops\nexit 3\n'}]})
+        e = self.assertRaises(mediaObj.MediaManagerException,
+                              media._collect_data)
+        self.assertIn('failed with code 3: oops', str(e))
+
+    def test_collect_data_timeout(self):
+        media = mediaObj.Media("Alphonse", {
+            'type': 'dynamic',
+            'sources': [
+                {'driver': 'script', 'target': 'a', 'timeout': 0.1,
+                 'value': '#!/bin/sh\nexec sleep 30\n'}]})
+        e = self.assertRaises(mediaObj.MediaManagerException,
+                              media._collect_data)
+        self.assertIn('timed out', str(e))
+
+    def test_collect_data_unknown_driver(self):
+        media = mediaObj.Media("Alphonse", {
+            'type': 'dynamic',
+            'sources': [{'driver': 'ftp', 'target': 'a'}]})
+        e = self.assertRaises(mediaObj.MediaManagerException,
+                              media._collect_data)
+        self.assertIn("'ftp'", str(e))
+
+    def test_convert(self):
+        image = os.path.join(self.tdir_empty, 'disk.img')
+        with open(image, 'wb') as f:
+            f.write(b'raw')
+        def qemu_img(cmd, **kwargs):
+            with open(cmd[-1], 'wb') as f:
+                f.write(b'qcow2')
+
+        with mock.patch.object(mediaObj.subprocess, 'check_output',
+                               side_effect=qemu_img) as check_output:
+            media = mediaObj.Media("Alphonse", {
+                'type': 'local', 'path': image, 'compress': True,
+                'filter_on': ['name', 'size', 'checksum']})
+            self.assertEqual('qcow2', media.disk_format)
+            self.assertEqual(image + '.compressed.qcow2', media.getPath())
+            # the filters don't convert the image
+            self.assertIsNone(media.checksum)
+            self.assertEqual(0, media.size)
+            self.assertFalse(check_output.called)
+
+            media.convert()
+            media.convert()
+            self.assertEqual(hashlib.md5(b'qcow2').hexdigest(),
+                             media.checksum)
+            self.assertEqual(5, media.size)
+        self.assertEqual(1, check_output.call_count)
+        self.assertEqual(['qemu-img', 'convert', '-f', 'raw', '-O', 'qcow2',
+                          '-c', image], check_output.call_args[0][0][:-1])
+        self.assertEqual(['disk.img', 'disk.img.compressed.qcow2'],
+                         sorted(os.listdir(self.tdir_empty)))
+
+    def test_convert_with_checksum(self):
+        self.assertRaises(mediaObj.MediaManagerException, mediaObj.Media,
+                          "Alphonse", {'type': 'local', 'path': '/a',
+                                       'convert_to': 'qcow2',
+                                       'checksum': 'abc'})
+
+    def test_convert_failure(self):
+        image = os.path.join(self.tdir_empty, 'disk.img')
+        open(image, 'wb').close()
+        media = mediaObj.Media("Alphonse", {'type': 'local', 'path': image,
+                                            'convert_to': 'qcow2'})
+        error = subprocess.CalledProcessError(1, 'qemu-img', b'oops')
+        with mock.patch.object(mediaObj.subprocess, 'check_output',
+                               side_effect=error):
+            self.assertRaises(mediaObj.MediaManagerException, media.convert)
+        self.assertEqual(['disk.img'], os.listdir(self.tdir_empty))
+
+    def test_no_conversion(self):
+        media = mediaObj.Media("Alphonse", {'type': 'local', 'path': '/a',
+                                            'disk_format': 'qcow2',
+                                            'convert_to': 'qcow2'})
+        self.assertEqual('/a', media.getPath())
+        remote = mediaObj.Media("Alphonse", {'type': 'remote',
+                                             'copy_from': 'http://a/b',
+                                             'convert_to': 'qcow2'})
+        remote.convert()
+        self.assertIsNone(remote.getPath())
+
+    def test_fetch(self):
+        media = mediaObj.Media("Alphonse", {'type': 'remote',
+                                            'copy_from': 'http://a/b',
+                                            'checksum': 'abc',
+                                            'fetch': True})
+        self.assertIsNone(media.copy_from)
+        self.assertIsNone(media.getPath())
+        with mock.patch('mincer.utils.fetch.fetch',
+                        return_value='/cache/b') as fetch:
+            media.generate()
+        fetch.assert_called_once_with('http://a/b', 'abc')
+        self.assertEqual('/cache/b', media.getPath())
+        self.assertEqual(
+            mediaObj.Media("Bob", {'type': 'remote',
+                                   'copy_from': 'http://a/b'})._quick_key(),
+            media._quick_key())
+
+    def test_deduplicate(self):
+        url = 'http://my.mirror/ubuntu-vm.qcow2'
+        remote = {'type': 'remote', 'copy_from': url, 'disk_format': 'qcow2'}
+        for name in ('a', 'b'):
+            with open(os.path.join(self.tdir_empty, name), 'w') as f:
+                f.write('same')
+        with open(os.path.join(self.tdir_empty, 'c'), 'w') as f:
+            f.write('diff')
+        medias = [
+            mediaObj.Media('jenkins_image', remote),
+            mediaObj.Media('base_image', remote),
+            mediaObj.Media('iso', dict(remote, disk_format='iso')),
+            mediaObj.Media('no_url', {'type': 'remote'}),
+            mediaObj.Media('no_url_either', {'type': 'remote'})]
+        for name in ('a', 'b', 'c'):
+            medias.append(mediaObj.Media(name, {
+                'type': 'local',
+                'path': os.path.join(self.tdir_empty, name)}))
+
+        with mock.patch.object(fingerprint, 'checksum',
+                               wraps=fingerprint.checksum) as checksum:
+            groups = mediaObj.deduplicate(medias)
+        self.assertEqual(3, checksum.call_count)
+        self.assertEqual(
+            [['a', 'b'], ['base_image', 'jenkins_image'], ['c'], ['iso'],
+             ['no_url'], ['no_url_either']],
+            sorted([m.name for m in group] for group in groups))
+
+        # the checksum is not needed without an image of the same size
+        with open(os.path.join(self.tdir_empty, 'd'), 'w') as f:
+            f.write('longer')
+        other = mediaObj.Media('d', {
+            'type': 'local', 'path': os.path.join(self.tdir_empty, 'd')})
+        with mock.patch.object(fingerprint, 'checksum') as checksum:
+            mediaObj.deduplicate(medias[:3] + [medias[5], other])
+        self.assertFalse(checksum.called)
+
     def test__size_to_allocate(self):
         media = mediaObj.Media("Alphonse", SAMPLE_MEDIAS)
         size = media._size_to_allocate(self.tdir_with_data)
         self.assertGreaterEqual(size, media._min_image_size)
 
+        with open(self.tdir_with_data + '/big', 'wb') as f:
+            f.truncate(media._min_image_size)
+        size = media._size_to_allocate(self.tdir_with_data)
+        self.assertGreater(size, media._min_image_size * 1.15)
+        self.assertEqual(0, size % (1024 * 1024))
+
+    def test__size_to_allocate_from_inodes(self):
+        media = mediaObj.Media("Alphonse", SAMPLE_MEDIAS)
+        for i in range(2000):
+            open('%s/%d' % (self.tdir_empty, i), 'w').close()
+        size = media._size_to_allocate(self.tdir_empty)
+        self.assertGreater(size, 2000 * mediaObj.BYTES_PER_INODE)
+
+        journaled = mediaObj.Media("Alphonse", dict(SAMPLE_MEDIAS,
+                                                    filesystem='ext4'))
+        self.assertGreater(journaled._size_to_allocate(self.tdir_empty),
+                           size)
+
+    def test_produce_qcow2_image(self):
+        media = mediaObj.Media("Alphonse", dict(SAMPLE_MEDIAS,
+                                                disk_format='qcow2',
+                                                filesystem='ext4'))
+        fake_guestfs = mock.Mock()
+        g = fake_guestfs.GuestFS.return_value
+        g.list_devices.return_value = ['/dev/sda']
+        g.list_partitions.return_value = ['/dev/sda1']
+        g.part_to_dev.return_value = '/dev/sda'
+        with mock.patch.dict('sys.modules', guestfs=fake_guestfs), \
+                mock.patch.object(media, '_tar_in') as tar_in:
+            media._produce_image()
+        g.disk_create.assert_called_once_with(
+            media._dynamic_image, 'qcow2', mock.ANY)
+        g.add_drive_opts.assert_called_once_with(
+            media._dynamic_image, format='qcow2', readonly=0)
+        g.mkfs.assert_called_once_with('ext4', '/dev/sda1')
+        tar_in.assert_called_once_with(g, '/')
+        g.close.assert_called_once_with()
+
+    def test_dynamic_disk_format(self):
+        self.assertRaises(mediaObj.MediaManagerException, mediaObj.Media,
+                          "Alphonse", dict(SAMPLE_MEDIAS, disk_format='iso'))
+
+    def test_tar_in_streams_the_data(self):
+        media = mediaObj.Media("Alphonse", SAMPLE_MEDIAS)
+        _add_some_files(media.data_dir)
+        members = []
+
+        def tar_in(path, directory):
+            self.assertEqual('/', directory)
+            with tarfile.open(path, 'r|') as tar:
+                members.extend(m.name for m in tar)
+
+        g = mock.Mock()
+        g.tar_in.side_effect = tar_in
+        media._tar_in(g, '/')
+        self.assertEqual(['data', 'data/foo', 'data/foo/bar',
+                          'data/foo/bar/file', 'data/foo/file'],
+                         sorted(members))
+        self.assertEqual(['data'], os.listdir(media.basedir))
+
+    def test_tar_in_failure(self):
+        media = mediaObj.Media("Alphonse", SAMPLE_MEDIAS)
+        with open(media.data_dir + '/big', 'wb') as f:
+            f.truncate(media._min_image_size)
+        g = mock.Mock()
+        g.tar_in.side_effect = RuntimeError('appliance died')
+        self.assertRaises(RuntimeError, media._tar_in, g, '/')
+
 if __name__ == '__main__':
     unittest.main()
@@ -75,6 +75,8 @@ class TestSSH(testtools.TestCase):
                 mock.Mock(return_value=True))
     @mock.patch('paramiko.SFTPClient.from_transport',
                 mock.Mock())
+    @mock.patch('mincer.utils.retry.port_is_open',
+                mock.Mock(return_value=True))
     def test_start_transport(self):
         # without user_config
         self.ssh.get_user_config = mock.Mock(return_value={})
@@ -137,3 +139,65 @@ class TestSSH(testtools.TestCase):
                           client,
                           {},
                           {})
+
+    @mock.patch('time.sleep', mock.Mock())
+    def test__try_start_ssh_client_waits_for_sshd(self):
+        client = mock.Mock()
+        with mock.patch('mincer.utils.retry.port_is_open',
+                        mock.Mock(side_effect=[False, False, True])):
+            self.ssh._try_start_ssh_client(client,
+                                           {'hostname': '127.0.0.1'}, {})
+        client.connect.assert_called_once_with(hostname='127.0.0.1')
+        self.assertEqual(client, self.ssh._ssh_client)
+
+    @mock.patch('time.sleep', mock.Mock())
+    def test__open_channel_retries_refused_channels(self):
+        self.ssh._ssh_client = mock.Mock()
+        open_channel = self.ssh._ssh_client.get_transport().open_channel
+        open_channel.side_effect = [
+            paramiko.ChannelException(2, 'Connect failed'), 'channel']
+        self.assertEqual('channel', self.ssh._open_channel('127.0.0.1'))
+        self.assertEqual(2, open_channel.call_count)
+
+    def test_get_transport_reuses_healthy_transport(self):
+        transport = mock.Mock()
+        transport.is_active.return_value = True
+        transport.is_authenticated.return_value = True
+        self.ssh._transports['127.0.0.1'] = transport
+        self.ssh._connect = mock.Mock()
+        self.assertEqual(transport, self.ssh.get_transport('127.0.0.1'))
+        self.assertFalse(self.ssh._connect.called)
+
+    def test_get_transport_reconnects_broken_transport(self):
+        transport = mock.Mock()
+        transport.is_active.return_value = True
+        transport.is_authenticated.return_value = True
+        transport.send_ignore.side_effect = EOFError()
+        self.ssh._transports['127.0.0.1'] = transport
+        self.ssh._connect = mock.Mock()
+        self.assertEqual(self.ssh._connect.return_value,
+                         self.ssh.get_transport('127.0.0.1'))
+        transport.close.assert_called_once_with()
+        self.assertEqual(self.ssh._connect.return_value,
+                         self.ssh._transports['127.0.0.1'])
+
+    def test_open_session_retries_once(self):
+        dead = mock.Mock()
+        dead.open_session.side_effect = paramiko.ssh_exception.SSHException()
+        fresh = mock.Mock()
+        self.ssh.get_transport = mock.Mock(side_effect=[dead, fresh])
+        self.ssh._transports['127.0.0.1'] = dead
+        self.assertEqual(fresh.open_session.return_value,
+                         self.ssh.open_session('127.0.0.1'))
+        dead.close.assert_called_once_with()
+        self.assertNotIn('127.0.0.1', self.ssh._transports)
+
+    def test_close(self):
+        transport = mock.Mock()
+        client = mock.Mock()
+        self.ssh._transports['127.0.0.1'] = transport
+        self.ssh._ssh_client = client
+        self.ssh.close()
+        transport.close.assert_called_once_with()
+        client.close.assert_called_once_with()
+        self.assertEqual({}, self.ssh._transports)